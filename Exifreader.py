@@ -64,6 +64,17 @@
 # To do:
 # * Better printing of ratios
 
+import os
+import stat
+import types
+import struct
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import cStringIO
+import tarfile
+import zipfile
+
 # field type descriptions as (length, abbreviation, full name) tuples
 FIELD_TYPES=(
     (0, 'X',  'Proprietary'), # no such type
@@ -638,6 +649,10 @@ class ExifError(Exception):
     def __str__(self):
         return repr(self.parameter)
 
+class ExifBudgetError(ExifError):
+    """Raised when a file needs more work to parse than its budget allows"""
+    pass
+
     
 # extract multibyte integer in Motorola format (little endian)
 def s2n_motorola(str):
@@ -655,6 +670,18 @@ def s2n_intel(str):
         y=y+8
     return x
 
+# precompiled decoders for the 1, 2 and 4 byte integer fields, so that
+# values can be pulled straight out of the header buffer
+INTEL_UNPACKERS={1: struct.Struct('<B'),
+                 2: struct.Struct('<H'),
+                 4: struct.Struct('<I')}
+MOTOROLA_UNPACKERS={1: struct.Struct('>B'),
+                    2: struct.Struct('>H'),
+                    4: struct.Struct('>I')}
+
+# struct format characters for arrays of 1, 2 and 4 byte integers
+ARRAY_FORMATS={1: 'B', 2: 'H', 4: 'I'}
+
 # ratio object that eventually will be able to reduce itself to lowest
 # common denominator for printing
 def gcd(a, b):
@@ -663,7 +690,9 @@ def gcd(a, b):
    else:
       return gcd(b, a % b)
 
-class Ratio:
+class Ratio(object):
+    __slots__=('num', 'den')
+
     def __init__(self, num, den):
         self.num=num
         self.den=den
@@ -680,12 +709,199 @@ class Ratio:
             self.num=self.num/div
             self.den=self.den/div
 
+# array of ratios stored as a flat list of numerators and denominators,
+# Ratio objects are only created for the elements that are looked at
+class Ratios:
+    def __init__(self, pairs):
+        self.pairs=pairs
+
+    def __len__(self):
+        return len(self.pairs)/2
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i+=len(self)
+        if not 0 <= i < len(self):
+            raise IndexError, 'ratio index out of range'
+        return Ratio(self.pairs[2*i], self.pairs[2*i+1])
+
+    def __repr__(self):
+        return repr(self[:])
+
+# work out the printable version of the values of a tag, using the
+# optional 2nd element of its entry in the tag dictionary (a mapping
+# function or a LUT) if there is one
+# values are a list of ints (or Ratios), so arrays print as [0, 2] and
+# not the [0L, 2L] of the old list of longs
+def printable_values(values, count, field_type, tag_entry):
+    if count == 1 and field_type != 2:
+        printable=str(values[0])
+    else:
+        printable=str(values)
+    if tag_entry and len(tag_entry) != 1:
+        # optional 2nd tag element is present
+        if callable(tag_entry[1]):
+            # call mapping function
+            printable=tag_entry[1](values)
+        else:
+            printable=''
+            for i in values:
+                # use LUT for this tag
+                printable+=tag_entry[1].get(i, repr(i))
+    return printable
+
+# limits on the work that one file can make the parser do, so that a
+# corrupt or truncated file can't hang a scan or make it read gigabytes.
+# Real files come nowhere near these.
+MAX_IFDS=64
+MAX_ENTRIES=16384
+MAX_VALUE_BYTES=16*1024*1024
+
+# what is left of the parse budget of a file. Every IFD, IFD entry and
+# byte of tag values decoded is charged to it and ExifBudgetError is raised
+# once any of them runs out.
+class ParseBudget:
+    def __init__(self, ifds=MAX_IFDS, entries=MAX_ENTRIES,
+                 value_bytes=MAX_VALUE_BYTES):
+        self.ifds=ifds
+        self.entries=entries
+        self.value_bytes=value_bytes
+
+    def charge_ifd(self, ifd):
+        self.ifds-=1
+        if self.ifds < 0:
+            raise ExifBudgetError, 'too many IFDs (at offset %d)' % ifd
+
+    def charge_entries(self, count):
+        self.entries-=count
+        if self.entries < 0:
+            raise ExifBudgetError, 'too many IFD entries'
+
+    def charge_bytes(self, length):
+        self.value_bytes-=length
+        if self.value_bytes < 0:
+            raise ExifBudgetError, 'too much tag data'
+
+# the tags found in a file, as returned by process_file. warnings lists
+# anything that stopped the file from being read completely (eg a looping
+# IFD chain or running out of budget), the tags are then what was decoded
+# up to that point.
+# Few callers want the MakerNote, so it isn't decoded until somebody asks
+# for one of its tags. Then all of it is decoded, once, and every later
+# lookup (found or not) is answered from the tags it added.
+class ExifTags(dict):
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.warnings=[]
+        # (header, names, thumbnail) of a MakerNote that is still to be
+        # decoded
+        self.maker_note=None
+
+    # leave the MakerNote of hdr to be decoded when it is needed. names are
+    # the MakerNote tags that may be decoded, None for all of them.
+    # thumbnail is true if the JPEGThumbnail may be hidden in it
+    def defer_maker_note(self, hdr, names, thumbnail):
+        self.maker_note=(hdr, names, thumbnail)
+
+    # decode the MakerNote, if that hasn't been done yet
+    def decode_maker_note(self):
+        if self.maker_note is None:
+            return
+        hdr, names, thumbnail=self.maker_note
+        # decoding looks up tags itself, which mustn't decode again
+        self.maker_note=None
+        try:
+            hdr.decode_maker_note(names)
+        except ExifError, msg:
+            # give up on the MakerNote but keep the rest of the tags
+            self.warnings.append('MakerNote: %s' % msg.parameter)
+        except (KeyError, IndexError, struct.error), msg:
+            # eg no 'Image Make' to tell how to read it, or a broken note.
+            # This happens on a later lookup, so it mustn't raise either
+            self.warnings.append('MakerNote: %s'
+                                 % (str(msg) or msg.__class__.__name__))
+        # Sometimes in a TIFF file, a JPEG thumbnail is hidden in the
+        # MakerNote since it's not allowed in a uncompressed TIFF IFD
+        thumb_off=dict.get(self, 'MakerNote JPEGThumbnail')
+        if thumbnail and thumb_off:
+            self['JPEGThumbnail']=Thumbnail(hdr.data,
+                                            hdr.offset+thumb_off.values[0],
+                                            thumb_off.field_length)
+
+    def decode_key(self, key):
+        if self.maker_note is None:
+            return
+        if key.startswith('MakerNote ') or \
+               (key == 'JPEGThumbnail' and self.maker_note[2]):
+            self.decode_maker_note()
+
+    def __getitem__(self, key):
+        self.decode_key(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self.decode_key(key)
+        return dict.get(self, key, default)
+
+    def has_key(self, key):
+        self.decode_key(key)
+        return dict.has_key(self, key)
+
+    def __contains__(self, key):
+        self.decode_key(key)
+        return dict.__contains__(self, key)
+
+    def keys(self):
+        self.decode_maker_note()
+        return dict.keys(self)
+
+    def values(self):
+        self.decode_maker_note()
+        return dict.values(self)
+
+    def items(self):
+        self.decode_maker_note()
+        return dict.items(self)
+
+    def iterkeys(self):
+        self.decode_maker_note()
+        return dict.iterkeys(self)
+
+    def itervalues(self):
+        self.decode_maker_note()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self.decode_maker_note()
+        return dict.iteritems(self)
+
+    def __iter__(self):
+        self.decode_maker_note()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.decode_maker_note()
+        return dict.__len__(self)
+
+    # a MakerNote is only there if 'EXIF MakerNote' is, so there is no
+    # need to decode it to know whether there are any tags
+    def __nonzero__(self):
+        return dict.__len__(self) > 0
+
 # for ease of dealing with tags
-class IFD_Tag:
+# most of the tags that get read are never printed, so the printable
+# version is only worked out (from tag_entry, the tag dictionary entry)
+# the first time it is asked for
+class IFD_Tag(object):
+    __slots__=('_printable', 'tag', 'field_type', 'values', 'field_offset',
+               'field_length', 'tag_entry')
+
     def __init__(self, printable, tag, field_type, values, field_offset,
-                 field_length):
-        # printable version of data
-        self.printable=printable
+                 field_length, tag_entry=None):
+        # printable version of data, None until it is needed
+        self._printable=printable
         # tag ID number
         self.tag=tag
         # field type as index into FIELD_TYPES
@@ -696,7 +912,21 @@ class IFD_Tag:
         self.field_length=field_length
         # either a string or array of data items
         self.values=values
-        
+        # entry for this tag in the tag dictionary, if any
+        self.tag_entry=tag_entry
+
+    def get_printable(self):
+        if self._printable is None:
+            count=self.field_length/FIELD_TYPES[self.field_type][0]
+            self._printable=printable_values(self.values, count,
+                                             self.field_type, self.tag_entry)
+        return self._printable
+
+    def set_printable(self, printable):
+        self._printable=printable
+
+    printable=property(get_printable, set_printable)
+
     def __str__(self):
         return self.printable
     
@@ -706,23 +936,83 @@ class IFD_Tag:
     #                                     self.printable,
     #                                     self.field_offset)
  
+# a thumbnail held in the buffer of a file, which is only copied out when
+# somebody wants it. str() gives the bytes, view() a buffer over them
+# that doesn't copy anything.
+class Thumbnail(object):
+    __slots__=('data', 'offset', 'length')
+
+    def __init__(self, data, offset, length):
+        self.data=data
+        # from the start of data
+        self.offset=offset
+        self.length=length
+
+    def __str__(self):
+        return self.data[self.offset:self.offset+self.length]
+
+    def __len__(self):
+        return max(0, min(self.length, len(self.data)-self.offset))
+
+    def view(self):
+        return buffer(self.data, self.offset, self.length)
+
+# an uncompressed TIFF thumbnail, which is only put together (from the
+# thumbnail IFD at thumb_ifd in hdr) when it is first wanted
+class TIFFThumbnail(object):
+    __slots__=('hdr', 'thumb_ifd', 'tiff')
+
+    def __init__(self, hdr, thumb_ifd):
+        self.hdr=hdr
+        self.thumb_ifd=thumb_ifd
+        self.tiff=None
+
+    def __str__(self):
+        if self.tiff is None:
+            self.tiff=self.hdr.extract_TIFF_thumbnail(self.thumb_ifd)
+            self.hdr=None
+        return self.tiff
+
+    def __len__(self):
+        return len(str(self))
+
+    def view(self):
+        return buffer(str(self))
+
 # class that handles an EXIF header
+# the whole TIFF structure is held in a buffer (data) which is read once,
+# offset is the position of the TIFF header within that buffer
 class EXIF_header:
-    def __init__(self, file, endian, offset, debug=0):
-        self.file=file
+    def __init__(self, data, endian, offset, debug=0, budget=None):
+        self.data=data
         self.endian=endian
         self.offset=offset
         self.debug=debug
-        self.tags={}
+        if budget is None:
+            budget=ParseBudget()
+        self.budget=budget
+        self.tags=ExifTags()
         
+    # return length bytes starting at offset (relative to the TIFF header)
+    def read(self, offset, length):
+        start=self.offset+offset
+        return self.data[start:start+length]
+
     # convert slice to integer, based on sign and endian flags
     def s2n(self, offset, length, signed=0):
-        self.file.seek(self.offset+offset)
-        slice=self.file.read(length)
         if self.endian == 'I':
-            val=s2n_intel(slice)
+            unpacker=INTEL_UNPACKERS.get(length)
         else:
-            val=s2n_motorola(slice)
+            unpacker=MOTOROLA_UNPACKERS.get(length)
+        try:
+            val=unpacker.unpack_from(self.data, self.offset+offset)[0]
+        except (AttributeError, struct.error):
+            # odd sized or truncated field, decode whatever is there
+            slice=self.read(offset, length)
+            if self.endian == 'I':
+                val=s2n_intel(slice)
+            else:
+                val=s2n_motorola(slice)
         # Sign extension ?
         if signed:
             #msb=1 << (8*length-1)
@@ -731,6 +1021,25 @@ class EXIF_header:
             pass
         return val
 
+    # convert count consecutive integers of the given length to a list
+    def s2n_array(self, offset, count, length):
+        if self.endian == 'I':
+            fmt='<%d%s' % (count, ARRAY_FORMATS.get(length, ''))
+        else:
+            fmt='>%d%s' % (count, ARRAY_FORMATS.get(length, ''))
+        try:
+            return list(struct.unpack_from(fmt, self.data,
+                                           self.offset+offset))
+        except struct.error:
+            # odd sized or truncated array, one at a time, but only as
+            # far as the data goes
+            count=min(count, max(0, self.available(offset)) // length)
+            return [self.s2n(offset+j*length, length) for j in range(count)]
+
+    # number of bytes of data from offset to the end
+    def available(self, offset):
+        return len(self.data)-self.offset-offset
+
     # convert offset to string
     def n2s(self, offset, length):
         s=''
@@ -752,20 +1061,40 @@ class EXIF_header:
         return self.s2n(ifd+2+12*entries, 4)
 
     # return list of IFDs in header
+    # a chain that loops back on itself, or is too long, is cut short
     def list_IFDs(self):
         i=self.first_IFD()
         a=[]
         while i:
+            if i in a:
+                self.tags.warnings.append('IFD chain loops back to offset %d'
+                                          % i)
+                break
+            if len(a) == MAX_IFDS:
+                self.tags.warnings.append('IFD chain cut short at %d IFDs'
+                                          % len(a))
+                break
             a.append(i)
             i=self.next_IFD(i)
         return a
 
     # return list of entries in this IFD
-    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS):
+    # if names is given, only the tags with those names are decoded
+    def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, names=None):
+        self.budget.charge_ifd(ifd)
         entries=self.s2n(ifd, 2)
+        self.budget.charge_entries(entries)
         for i in range(entries):
             entry=ifd+2+12*i
             tag=self.s2n(entry, 2)
+            # figure out tag name
+            tag_entry=dict.get(tag)
+            if tag_entry:
+                tag_name=tag_entry[0]
+            else:
+                tag_name='Tag 0x%04X' % tag
+            if names is not None and tag_name not in names:
+                continue
             field_type=self.s2n(entry+2, 2)
             if not 0 < field_type < len(FIELD_TYPES):
                 # unknown field type
@@ -778,50 +1107,37 @@ class EXIF_header:
                 # not the value, it's a pointer to the value
                 offset=self.s2n(offset, 4)
             field_offset=offset
+            # a value that runs past the end of the data is cut short
+            # to what is there
+            available=max(0, self.available(offset))
+            if count*typelen > available:
+                self.tags.warnings.append(
+                    '%s %s: %d bytes at offset %d, only %d there'
+                    % (ifd_name, tag_name, count*typelen, offset, available))
+                count=available // typelen
+                if count == 0:
+                    # nothing of it there, leave the tag out
+                    continue
+            self.budget.charge_bytes(count*typelen)
             if field_type == 2:
                 # special case: null-terminated ASCII string
                 if count != 0:
-                    self.file.seek(self.offset+offset)
-                    values=self.file.read(count).strip().replace('\x00','')
+                    values=self.read(offset, count).strip().replace('\x00','')
                 else:
                     values=''
             else:
-                values=[]
-                signed=(field_type in [6, 8, 9, 10])
-                for j in range(count):
-                    if field_type in (5, 10):
-                        # a ratio
-                        value_j=Ratio(self.s2n(offset,   4, signed),
-                                      self.s2n(offset+4, 4, signed))
-                    else:
-                        value_j=self.s2n(offset, typelen, signed)
-                    values.append(value_j)
-                    offset=offset+typelen
-            # now "values" is either a string or an array
-            if count == 1 and field_type != 2:
-                printable=str(values[0])
-            else:
-                printable=str(values)
-            # figure out tag name
-            tag_entry=dict.get(tag)
-            if tag_entry:
-                tag_name=tag_entry[0]
-                if len(tag_entry) != 1:
-                    # optional 2nd tag element is present
-                    if callable(tag_entry[1]):
-                        # call mapping function
-                        printable=tag_entry[1](values)
-                    else:
-                        printable=''
-                        for i in values:
-                            # use LUT for this tag
-                            printable+=tag_entry[1].get(i, repr(i))
-            else:
-                tag_name='Tag 0x%04X' % tag
-            self.tags[ifd_name+' '+tag_name]=IFD_Tag(printable, tag,
-                                                     field_type,
+                # the whole array is decoded in one go
+                if field_type in (5, 10):
+                    # ratios, kept as numerator/denominator pairs
+                    values=Ratios(self.s2n_array(offset, 2*count, 4))
+                else:
+                    values=self.s2n_array(offset, count, typelen)
+            # now "values" is either a string or an array, the printable
+            # version is left until somebody wants it
+            self.tags[ifd_name+' '+tag_name]=IFD_Tag(None, tag, field_type,
                                                      values, field_offset,
-                                                     count*typelen)
+                                                     count*typelen,
+                                                     tag_entry)
             if self.debug:
                 print '    %s: %s' % (tag_name,
                                       repr(self.tags[ifd_name+' '+tag_name]))
@@ -829,16 +1145,18 @@ class EXIF_header:
     # extract uncompressed TIFF thumbnail (like pulling teeth)
     # we take advantage of the pre-existing layout in the thumbnail IFD as
     # much as possible
+    # returns the thumbnail as a TIFF file in a string
     def extract_TIFF_thumbnail(self, thumb_ifd):
         entries=self.s2n(thumb_ifd, 2)
+        # the header and IFD are built up in a mutable buffer, so the
+        # offsets can be patched in place
         # this is header plus offset to IFD ...
         if self.endian == 'M':
-            tiff='MM\x00*\x00\x00\x00\x08'
+            tiff=bytearray('MM\x00*\x00\x00\x00\x08')
         else:
-            tiff='II*\x00\x08\x00\x00\x00'
+            tiff=bytearray('II*\x00\x08\x00\x00\x00')
         # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff+=self.file.read(entries*12+2)+'\x00\x00\x00\x00'
+        tiff+=self.read(thumb_ifd, entries*12+2)+'\x00\x00\x00\x00'
         
         # fix up large value offset pointers into data area
         for i in range(entries):
@@ -856,34 +1174,37 @@ class EXIF_header:
                 strip_len=count*typelen
             # is it in the data area?
             if count*typelen > 4:
-                # update offset pointer (nasty "strings are immutable" crap)
-                # should be able to say "tiff[ptr:ptr+4]=newoff"
+                # update offset pointer
                 newoff=len(tiff)
-                tiff=tiff[:ptr]+self.n2s(newoff, 4)+tiff[ptr+4:]
+                tiff[ptr:ptr+4]=self.n2s(newoff, 4)
                 # remember strip offsets location
                 if tag == 0x0111:
                     strip_off=newoff
                     strip_len=4
                 # get original data and store it
-                self.file.seek(self.offset+oldoff)
-                tiff+=self.file.read(count*typelen)
+                tiff+=self.read(oldoff, count*typelen)
                 
         # add pixel strips and update strip offset info
+        # the strips are only collected here and joined on in one go
         old_offsets=self.tags['Thumbnail StripOffsets'].values
         old_counts=self.tags['Thumbnail StripByteCounts'].values
+        strips=[]
+        end=len(tiff)
         for i in range(len(old_offsets)):
-            # update offset pointer (more nasty "strings are immutable" crap)
-            offset=self.n2s(len(tiff), strip_len)
-            tiff=tiff[:strip_off]+offset+tiff[strip_off+strip_len:]
+            # update offset pointer
+            tiff[strip_off:strip_off+strip_len]=self.n2s(end, strip_len)
             strip_off+=strip_len
             # add pixel strip to end
-            self.file.seek(self.offset+old_offsets[i])
-            tiff+=self.file.read(old_counts[i])
+            self.budget.charge_bytes(old_counts[i])
+            strip=self.read(old_offsets[i], old_counts[i])
+            strips.append(strip)
+            end+=len(strip)
             
-        self.tags['TIFFThumbnail']=tiff
+        return ''.join([str(tiff)]+strips)
         
     # decode all the camera-specific MakerNote formats
-    def decode_maker_note(self):
+    # if names is given, only the MakerNote tags with those names are decoded
+    def decode_maker_note(self, names=None):
         note=self.tags['EXIF MakerNote']
         make=self.tags['Image Make'].printable
         model=self.tags['Image Model'].printable
@@ -893,59 +1214,73 @@ class EXIF_header:
             if note.values[0:5] == [78, 105, 107, 111, 110]: # "Nikon"
                 # older model
                 self.dump_IFD(note.field_offset+8, 'MakerNote',
-                              dict=MAKERNOTE_NIKON_OLDER_TAGS)
+                              dict=MAKERNOTE_NIKON_OLDER_TAGS, names=names)
             else:
                 # newer model (E99x or D1)
                 self.dump_IFD(note.field_offset, 'MakerNote',
-                              dict=MAKERNOTE_NIKON_NEWER_TAGS)
+                              dict=MAKERNOTE_NIKON_NEWER_TAGS, names=names)
             return
 
         # Olympus
         if make[:7] == 'OLYMPUS':
             self.dump_IFD(note.field_offset+8, 'MakerNote',
-                          dict=MAKERNOTE_OLYMPUS_TAGS)
+                          dict=MAKERNOTE_OLYMPUS_TAGS, names=names)
             return
 
         # Casio
         if make == 'Casio':
             self.dump_IFD(note.field_offset, 'MakerNote',
-                          dict=MAKERNOTE_CASIO_TAGS)
+                          dict=MAKERNOTE_CASIO_TAGS, names=names)
             return
         
         # Fujifilm
         if make == 'FUJIFILM':
             # bug: everything else is "Motorola" endian, but the MakerNote
             # is "Intel" endian 
-            endian=self.endian
-            self.endian='I'
             # bug: IFD offsets are from beginning of MakerNote, not
             # beginning of file header
-            offset=self.offset
-            self.offset+=note.field_offset
-            # process note with bogus values (note is actually at offset 12)
-            self.dump_IFD(12, 'MakerNote', dict=MAKERNOTE_FUJIFILM_TAGS)
-            # reset to correct values
-            self.endian=endian
-            self.offset=offset
+            # so the note gets a header of its own with the right values,
+            # which shares the buffer and tags with this one
+            note_hdr=EXIF_header(self.data, 'I',
+                                 self.offset+note.field_offset, self.debug,
+                                 self.budget)
+            note_hdr.tags=self.tags
+            # (note is actually at offset 12)
+            note_hdr.dump_IFD(12, 'MakerNote', dict=MAKERNOTE_FUJIFILM_TAGS,
+                              names=names)
             return
         
         # Canon
         if make == 'Canon':
+            subtags=(('Tag 0x0001', MAKERNOTE_CANON_TAG_0x001),
+                     ('Tag 0x0004', MAKERNOTE_CANON_TAG_0x004))
+            ifd_names=names
+            if names is not None:
+                # the settings arrays have to be read for any of the
+                # tags packed into them
+                ifd_names=set(names)
+                for i in subtags:
+                    for x in i[1].values():
+                        if x[0] in names:
+                            ifd_names.add(i[0])
             self.dump_IFD(note.field_offset, 'MakerNote',
-                          dict=MAKERNOTE_CANON_TAGS)
-            for i in (('MakerNote Tag 0x0001', MAKERNOTE_CANON_TAG_0x001),
-                      ('MakerNote Tag 0x0004', MAKERNOTE_CANON_TAG_0x004)):
-                self.canon_decode_tag(self.tags[i[0]].values, i[1])
+                          dict=MAKERNOTE_CANON_TAGS, names=ifd_names)
+            for i in subtags:
+                tag=self.tags.get('MakerNote '+i[0])
+                if tag:
+                    self.canon_decode_tag(tag.values, i[1], names)
             return
 
     # decode Canon MakerNote tag based on offset within tag
     # see http://www.burren.cx/david/canon.html by David Burren
-    def canon_decode_tag(self, value, dict):
+    def canon_decode_tag(self, value, dict, names=None):
         for i in range(1, len(value)):
             x=dict.get(i, ('Unknown', ))
             if self.debug:
                 print i, x
             name=x[0]
+            if names is not None and name not in names:
+                continue
             if len(x) > 1:
                 val=x[1].get(value[i], 'Unknown')
             else:
@@ -955,30 +1290,113 @@ class EXIF_header:
             self.tags['MakerNote '+name]=IFD_Tag(str(val), None, 0, None,
                                                  None, None)
 
-# process an image file (expects an open file object)
+# get at the contents of a whole file as a buffer. Real files are memory
+# mapped, so only the pages holding the IFDs and values that are looked at
+# get read in. Only plain files on disk that are positioned at the start
+# are mapped. Returns None for anything else (pipes, archive members,
+# gzip files, whose fileno() is the compressed file, a file positioned at
+# an image inside it, ...), those are read as a stream
+def map_file(file):
+    if not isinstance(file, types.FileType):
+        return None
+    try:
+        if file.tell() != 0 or \
+               not stat.S_ISREG(os.fstat(file.fileno()).st_mode):
+            return None
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError, mmap.error):
+        return None
+
+# a file.read() work-alike that reads a mapped file from the start, by
+# position, without going near the file's own position. Every call gets
+# a reader of its own, so parsing keeps no state on the file and files
+# can be parsed in several threads at once.
+def map_reader(data):
+    pos=[0]
+    def read(length=-1):
+        if length < 0:
+            length=len(data)
+        chunk=data[pos[0]:pos[0]+length]
+        pos[0]+=len(chunk)
+        return chunk
+    return read
+
+# work out which tags of the IFD called ifd_name have to be decoded to get
+# at the wanted tags (full 'IFD_name tag_name' keys), including the
+# pointers needed to find the other IFDs. None means decode everything.
+def wanted_names(wanted_tags, ifd_name):
+    if wanted_tags is None:
+        return None
+    names=set()
+    prefix=ifd_name+' '
+    for key in wanted_tags:
+        if key.startswith(prefix):
+            names.add(key[len(prefix):])
+        if ifd_name == 'Image':
+            if key.startswith('EXIF ') or key.startswith('MakerNote '):
+                names.add('ExifOffset')
+            if key.startswith('GPS '):
+                names.add('GPSInfo')
+            if key.startswith('MakerNote '):
+                # the MakerNote format depends on the camera
+                names.update(('Make', 'Model'))
+        elif ifd_name == 'EXIF':
+            if key.startswith('MakerNote '):
+                names.add('MakerNote')
+        elif ifd_name == 'Thumbnail':
+            if key == 'JPEGThumbnail':
+                names.update(('JPEGInterchangeFormat',
+                              'JPEGInterchangeFormatLength'))
+            elif key == 'TIFFThumbnail':
+                names.update(('Compression', 'StripOffsets',
+                              'StripByteCounts'))
+    return names
+
+# process an image file (expects an open file object, positioned at the
+# start of the image). Real files are mapped and read by position, anything
+# else is only ever read forwards, so it can also be a pipe or a member of
+# an archive. For JPEGs just the APP1 segment is read.
 # this is the function that has to deal with all the arbitrary nasty bits
 # of the EXIF standard
-def process_file(file, debug=0):
+# the EXIF block is read into memory in one go and all decoding is done
+# from that buffer, instead of seeking around the file for every field
+# wanted_tags is an optional list of the tag keys (as in the returned
+# dictionary, for eg 'EXIF FNumber') that the caller is interested in.
+# Only those are decoded, IFDs, thumbnails and MakerNotes that can't hold
+# any of them are skipped, and parsing stops once all have been found.
+# budget is the ParseBudget for the file, by default the MAX_ limits. If
+# it runs out, the tags decoded so far are returned with a warning.
+def process_file(file, debug=0, wanted_tags=None, budget=None):
+    mapped=map_file(file)
+    if mapped is not None:
+        read=map_reader(mapped)
+    else:
+        read=file.read
     # determine whether it's a JPEG or TIFF
-    data=file.read(12)
+    data=read(12)
     if data[0:4] in ['II*\x00', 'MM\x00*']:
-        # it's a TIFF file
-        file.seek(0)
-        endian=file.read(1)
-        file.read(1)
+        # it's a TIFF file, the IFDs can be anywhere in it
+        if mapped is not None:
+            data=mapped
+        else:
+            data+=read()
+        endian=data[0:1]
         offset=0
     elif data[0:2] == '\xFF\xD8':
         # it's a JPEG file
         # skip JFIF style header(s)
         while data[2] == '\xFF' and data[6:10] in ('JFIF', 'JFXX', 'OLYM'):
             length=ord(data[4])*256+ord(data[5])
-            file.read(length-8)
+            read(length-8)
             # fake an EXIF beginning of file
-            data='\xFF\x00'+file.read(10)
+            data='\xFF\x00'+read(10)
         if data[2] == '\xFF' and data[6:10] == 'Exif':
-            # detected EXIF header
-            offset=file.tell()
-            endian=file.read(1)
+            # detected EXIF header, everything we need is in the rest
+            # of this APP1 segment
+            length=ord(data[4])*256+ord(data[5])
+            data=read(length-8)
+            endian=data[0:1]
+            offset=0
         else:
             raise ExifError, "no exif information"
             # no EXIF information
@@ -991,7 +1409,19 @@ def process_file(file, debug=0):
     # deal with the EXIF info we found
     if debug:
         print {'I': 'Intel', 'M': 'Motorola'}[endian], 'format'
-    hdr=EXIF_header(file, endian, offset, debug)
+    hdr=EXIF_header(data, endian, offset, debug, budget)
+    try:
+        decode_IFDs(hdr, debug, wanted_tags)
+    except ExifBudgetError, msg:
+        # hand back whatever was decoded before the budget ran out
+        hdr.tags.warnings.append(msg.parameter)
+    return hdr.tags
+
+# decode the IFDs of a header found by process_file, with the thumbnails
+# and MakerNote, into hdr.tags
+def decode_IFDs(hdr, debug=0, wanted_tags=None):
+    if wanted_tags is not None:
+        wanted_tags=set(wanted_tags)
     ifd_list=hdr.list_IFDs()
     ctr=0
     for i in ifd_list:
@@ -1002,15 +1432,21 @@ def process_file(file, debug=0):
             thumb_ifd=i
         else:
             IFD_name='IFD %d' % ctr
+        ctr+=1
+        names=wanted_names(wanted_tags, IFD_name)
+        if names is not None and not names:
+            # nothing we want in here
+            continue
         if debug:
-            print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
-        hdr.dump_IFD(i, IFD_name)
+            print ' IFD %d (%s) at offset %d:' % (ctr-1, IFD_name, i)
+        hdr.dump_IFD(i, IFD_name, names=names)
         # EXIF IFD
         exif_off=hdr.tags.get(IFD_name+' ExifOffset')
         if exif_off:
             if debug:
                 print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
-            hdr.dump_IFD(exif_off.values[0], 'EXIF')
+            hdr.dump_IFD(exif_off.values[0], 'EXIF',
+                         names=wanted_names(wanted_tags, 'EXIF'))
             # Interoperability IFD contained in EXIF IFD
             intr_off=hdr.tags.get('EXIF SubIFD InteroperabilityOffset')
             if intr_off:
@@ -1018,40 +1454,192 @@ def process_file(file, debug=0):
                     print ' EXIF Interoperability SubSubIFD at offset %d:' \
                           % intr_off.values[0]
                 hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
-                             dict=INTR_TAGS)
+                             dict=INTR_TAGS,
+                             names=wanted_names(wanted_tags,
+                                                'EXIF Interoperability'))
         # GPS IFD
         gps_off=hdr.tags.get(IFD_name+' GPSInfo')
         if gps_off:
             if debug:
                 print ' GPS SubIFD at offset %d:' % gps_off.values[0]
-            hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS)
-        ctr+=1
+            hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS,
+                         names=wanted_names(wanted_tags, 'GPS'))
+        # stop as soon as we have everything that was asked for
+        if wanted_tags is not None and wanted_tags.issubset(hdr.tags):
+            break
 
-    # extract uncompressed TIFF thumbnail
+    # extract uncompressed TIFF thumbnail, the thumbnails are only
+    # referred to and not copied out until they are used
     thumb=hdr.tags.get('Thumbnail Compression')
-    if thumb and thumb.printable == 'Uncompressed TIFF':
-        hdr.extract_TIFF_thumbnail(thumb_ifd)
+    if thumb and thumb.printable == 'Uncompressed TIFF' and \
+           (wanted_tags is None or 'TIFFThumbnail' in wanted_tags):
+        hdr.tags['TIFFThumbnail']=TIFFThumbnail(hdr, thumb_ifd)
         
     # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
     thumb_off=hdr.tags.get('Thumbnail JPEGInterchangeFormat')
-    if thumb_off:
-        file.seek(offset+thumb_off.values[0])
-        size=hdr.tags['Thumbnail JPEGInterchangeFormatLength'].values[0]
-        hdr.tags['JPEGThumbnail']=file.read(size)
+    thumb_len=hdr.tags.get('Thumbnail JPEGInterchangeFormatLength')
+    if thumb_off and thumb_len and \
+           (wanted_tags is None or 'JPEGThumbnail' in wanted_tags):
+        hdr.tags['JPEGThumbnail']=Thumbnail(hdr.data,
+                                            hdr.offset+thumb_off.values[0],
+                                            thumb_len.values[0])
         
     # deal with MakerNote contained in EXIF IFD
-    if hdr.tags.has_key('EXIF MakerNote'):
-        hdr.decode_maker_note()
-
-    # Sometimes in a TIFF file, a JPEG thumbnail is hidden in the MakerNote
-    # since it's not allowed in a uncompressed TIFF IFD
-    if not hdr.tags.has_key('JPEGThumbnail'):
-        thumb_off=hdr.tags.get('MakerNote JPEGThumbnail')
-        if thumb_off:
-            file.seek(offset+thumb_off.values[0])
-            hdr.tags['JPEGThumbnail']=file.read(thumb_off.field_length)
-            
-    return hdr.tags
+    names=wanted_names(wanted_tags, 'MakerNote')
+    # the JPEGThumbnail may be hidden in it, see ExifTags.decode_maker_note
+    thumbnail=(wanted_tags is None or 'JPEGThumbnail' in wanted_tags) and \
+               not hdr.tags.has_key('JPEGThumbnail')
+    if names is not None and thumbnail:
+        names.add('JPEGThumbnail')
+    if hdr.tags.has_key('EXIF MakerNote') and (names is None or names):
+        # only decoded when one of its tags is asked for
+        hdr.tags.defer_maker_note(hdr, names, thumbnail)
+
+# process an image that is already in memory as a string
+def process_data(data, debug=0, wanted_tags=None):
+    return process_file(cStringIO.StringIO(data), debug, wanted_tags)
+
+# Canon CR2 RAW files are TIFF based, and the first IFD describes a full
+# size JPEG rendering of the RAW data that can be shown without developing
+# the RAW. Returns its (offset, length) in the file, or None if this is
+# not a CR2 file or there is no preview.
+def cr2_preview_location(file):
+    file.seek(0)
+    header=file.read(10)
+    if header[0:4] not in ['II*\x00', 'MM\x00*'] or header[8:10] != 'CR':
+        return None
+    file.seek(0)
+    tags=process_file(file, wanted_tags=['Image StripOffsets',
+                                         'Image StripByteCounts'])
+    offsets=tags.get('Image StripOffsets')
+    counts=tags.get('Image StripByteCounts')
+    if not offsets or not counts or not offsets.values or not counts.values:
+        return None
+    return offsets.values[0], counts.values[0]
+
+# return the embedded full size preview JPEG of a CR2 file, or None
+def extract_cr2_preview(file):
+    location=cr2_preview_location(file)
+    if not location:
+        return None
+    file.seek(location[0])
+    return file.read(location[1])
+
+# read the tags from an open stream (see process_file) into a compact
+# record for process_files and process_archive. The IFD_Tag objects are
+# boiled down to their printable strings so that the record is cheap to
+# keep or send back, and any failure is recorded rather than raised, so
+# one bad file doesn't stop the whole batch. Returns a
+# (name, {tag key: printable}, error) tuple, there can be both fields and
+# an error if only part of the file could be read. With wanted_tags, the
+# record only has those of them that the file has, not the pointers and
+# other tags that had to be decoded on the way.
+def process_stream(name, stream, wanted_tags=None):
+    try:
+        tags=process_file(stream, wanted_tags=wanted_tags)
+        if wanted_tags is None:
+            keys=tags.keys()
+        else:
+            keys=[key for key in wanted_tags if key in tags]
+        fields={}
+        for key in keys:
+            if key not in ('JPEGThumbnail', 'TIFFThumbnail'):
+                fields[key]=str(tags[key])
+    except ExifError, msg:
+        return name, {}, str(msg.parameter)
+    except Exception, msg:
+        return name, {}, str(msg) or msg.__class__.__name__
+    # only partly read, the warnings go in as the error
+    return name, fields, '; '.join(tags.warnings) or None
+
+# read the tags of the file at path for process_files, this is what runs in
+# the worker processes
+def process_path(job):
+    path, wanted_tags=job
+    try:
+        file=open(path, 'rb')
+    except EnvironmentError, msg:
+        return path, {}, str(msg)
+    try:
+        return process_stream(path, file, wanted_tags)
+    finally:
+        file.close()
+
+# process_path for a list of jobs, so that the workers get handed work
+# in chunks instead of one file at a time
+def process_paths(jobs):
+    return map(process_path, jobs)
+
+# read the tags of many files at once, spread over a pool of worker
+# processes (one per cpu by default). This is a generator, the records from
+# process_path are yielded in the same order as paths, as soon as they
+# (and all before them) are done. Only a couple of chunks per worker are
+# queued up at a time, so stopping early doesn't leave the pool chewing
+# through the rest of the files.
+# With threads, a pool of threads is used instead, which is much lighter
+# to start, eg for the viewer.
+def process_files(paths, workers=None, wanted_tags=None, chunksize=None,
+                  threads=False):
+    jobs=[(path, wanted_tags) for path in paths]
+    if workers is None:
+        workers=multiprocessing.cpu_count()
+    workers=min(workers, len(jobs))
+    if workers <= 1:
+        # not worth starting a pool
+        for job in jobs:
+            yield process_path(job)
+        return
+    if chunksize is None:
+        # a few chunks per worker so that the load stays balanced
+        chunksize=max(1, min(64, len(jobs) // (workers*4)))
+    if threads:
+        pool=multiprocessing.pool.ThreadPool(workers)
+    else:
+        pool=multiprocessing.Pool(workers)
+    pending=[]
+    try:
+        for start in range(0, len(jobs), chunksize):
+            pending.append(pool.apply_async(process_paths,
+                                            (jobs[start:start+chunksize],)))
+            if len(pending) > 2*workers:
+                for record in pending.pop(0).get():
+                    yield record
+        while pending:
+            for record in pending.pop(0).get():
+                yield record
+    finally:
+        pool.close()
+        pool.join()
+
+# read the tags of all the files in a zip or tar (optionally compressed)
+# archive without extracting it. Tars are read as a stream, front to back.
+# This is a generator yielding process_stream records, named after the
+# archive members.
+def process_archive(path, wanted_tags=None):
+    if zipfile.is_zipfile(path):
+        archive=zipfile.ZipFile(path)
+        try:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    # directory
+                    continue
+                member=archive.open(info)
+                try:
+                    yield process_stream(info.filename, member, wanted_tags)
+                finally:
+                    member.close()
+        finally:
+            archive.close()
+    else:
+        archive=tarfile.open(path, 'r|*')
+        try:
+            for info in archive:
+                if info.isfile():
+                    yield process_stream(info.name,
+                                         archive.extractfile(info),
+                                         wanted_tags)
+        finally:
+            archive.close()
 
 # library test/debug function (dump given files)
 if __name__ == '__main__':
@@ -1087,4 +1675,6 @@ if __name__ == '__main__':
                 print 'error', i, '"', data[i], '"'
         if data.has_key('JPEGThumbnail'):
             print 'File has JPEG thumbnail'
+        for warning in data.warnings:
+            print 'Warning:', warning
         print
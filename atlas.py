@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# Raja S
+
+"""Thumbnail atlas for a directory - the thumbnails of all its
+images as fixed size tiles of raw RGB in one file, with an index.
+The tiles file is memory mapped, so getting a thumbnail needs no
+file open or decoding. Entries are checked against the size and
+modification time of the file, and only the images that were
+added or have changed are rendered again"""
+
+import os
+import mmap
+import marshal
+import hashlib
+import Image
+from utils import load_thumbnail, get_thumbnailfile
+
+ATLAS_DIR = os.path.expanduser('~/.organizr_atlas')
+
+class ThumbnailAtlas():
+    """Thumbnails of the images in dirname, that fit in a square
+    of tn_size. The index is a dict of filename -
+    (slot, size, mtime, width, height, source), where source is
+    where the thumbnail came from (see utils.load_thumbnail).
+    Slots of files that have gone are reused"""
+    def __init__(self, dirname, tn_size=128, atlas_dir=ATLAS_DIR):
+        self.tn_size = tn_size
+        self.tile_bytes = tn_size * tn_size * 3
+        name = '%s-%d' % (hashlib.md5(os.path.abspath(dirname)).hexdigest(),
+                          tn_size)
+        self.index_file = os.path.join(atlas_dir, name + '.index')
+        self.tiles_file = os.path.join(atlas_dir, name + '.tiles')
+        if not os.path.exists(atlas_dir):
+            os.makedirs(atlas_dir, 0700)
+
+        self.entries = {}
+        self.free = [] # unused slots
+        self.slots = 0
+        self.tiles = None
+        self.read_index()
+        self.map()
+
+    def read_index(self):
+        """Load the index, starting afresh if it is missing or doesn't
+        match the tiles file"""
+        try:
+            self.entries, self.free, self.slots = marshal.load(
+                open(self.index_file, 'rb'))
+            if os.path.getsize(self.tiles_file) == \
+                   self.slots * self.tile_bytes:
+                return
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        self.entries, self.free, self.slots = {}, [], 0
+        open(self.tiles_file, 'wb').close()
+
+    def write_index(self):
+        """Save the index, through a temporary file so that an
+        interrupted write doesn't leave a broken index"""
+        tmp_file = self.index_file + '.tmp'
+        marshal.dump((self.entries, self.free, self.slots),
+                     open(tmp_file, 'wb'))
+        os.rename(tmp_file, self.index_file)
+
+    def map(self):
+        """Memory map the tiles file"""
+        if self.tiles is not None:
+            self.tiles.close()
+            self.tiles = None
+        if self.slots:
+            tiles_file = open(self.tiles_file, 'rb')
+            self.tiles = mmap.mmap(tiles_file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            tiles_file.close()
+
+    def is_current(self, filename, stat):
+        """Is the tile of filename (if any) made from the file as it
+        is now, and from the best thumbnail available"""
+        entry = self.entries.get(filename)
+        if entry is None or entry[1:3] != stat:
+            return False
+        # a freedesktop thumbnail may have been made since
+        return entry[5] == 'freedesktop' or not get_thumbnailfile(filename)
+
+    def update(self, filenames):
+        """Bring the atlas up to date with filenames, the images
+        that are now in the directory"""
+        stats = {}
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+                stats[filename] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                pass
+
+        changed = False
+        for filename in self.entries.keys():
+            if filename not in stats:
+                self.free.append(self.entries.pop(filename)[0])
+                changed = True
+
+        tiles_file = None
+        for filename in filenames:
+            if filename not in stats or \
+                   self.is_current(filename, stats[filename]):
+                continue
+            try:
+                tb, source = load_thumbnail(filename, self.tn_size)
+                tb.thumbnail((self.tn_size, self.tn_size))
+                data = tb.convert('RGB').tostring()
+            except:
+                continue # left out, tried again next time
+
+            if filename in self.entries:
+                slot = self.entries[filename][0]
+            elif self.free:
+                slot = self.free.pop()
+            else:
+                slot = self.slots
+                self.slots += 1
+            if tiles_file is None:
+                tiles_file = open(self.tiles_file, 'r+b')
+            # tiles are written at full size to keep the file's length
+            tiles_file.seek(slot * self.tile_bytes)
+            tiles_file.write(data.ljust(self.tile_bytes, '\0'))
+            self.entries[filename] = ((slot,) + stats[filename] +
+                                      tb.size + (source,))
+            changed = True
+
+        if tiles_file is not None:
+            tiles_file.close()
+        if changed:
+            self.write_index()
+            self.map()
+
+    def get(self, filename):
+        """The thumbnail of filename and its source, or None if it
+        isn't in the atlas"""
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        slot, size, mtime, width, height, source = entry
+        offset = slot * self.tile_bytes
+        return Image.fromstring('RGB', (width, height),
+                   self.tiles[offset:offset + width * height * 3]), source
+
+    def close(self):
+        if self.tiles is not None:
+            self.tiles.close()
+            self.tiles = None
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Raja S
+
+"""On disk cache of the exif tags read from image files, so that
+a folder only has to be parsed once. Entries are checked against
+the size and modification time of the file and reparsed when
+either has changed"""
+
+import os
+import sqlite3
+import marshal
+import Exifreader
+from utils import EXIF_INFO_TAGS
+
+CACHE_FILE = os.path.expanduser('~/.organizr_exifcache')
+# changed whenever what goes in an entry changes, to drop the old entries
+CACHE_FORMAT = 2
+
+class ExifCache():
+    """The tags in wanted_tags (by default all that ExifInfo needs)
+    for every file that has been read, stored in a sqlite database"""
+    def __init__(self, dbfile=CACHE_FILE, wanted_tags=EXIF_INFO_TAGS):
+        self.wanted_tags = wanted_tags
+        self.db = sqlite3.connect(dbfile)
+        self.db.text_factory = str
+        self.db.execute('CREATE TABLE IF NOT EXISTS exif '
+                        '(path TEXT PRIMARY KEY, dir TEXT, size INTEGER, '
+                        'mtime REAL, tags BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS exif_dir ON exif (dir)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS settings '
+                        '(key TEXT PRIMARY KEY, value TEXT)')
+        self.check_wanted_tags()
+        self.db.commit()
+
+    def check_wanted_tags(self):
+        """Entries read for another set of tags (or in an older
+        format) are of no use, throw them away if the tags have changed"""
+        wanted = '\n'.join([str(CACHE_FORMAT)] + sorted(self.wanted_tags))
+        row = self.db.execute('SELECT value FROM settings WHERE key = ?',
+                              ('wanted_tags',)).fetchone()
+        if row is None or row[0] != wanted:
+            self.db.execute('DELETE FROM exif')
+            self.db.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)',
+                            ('wanted_tags', wanted))
+
+    def lookup(self, dirnames):
+        """All the entries for files in the given directories, one
+        query per directory. Returns a dict of path - (size, mtime, tags)"""
+        entries = {}
+        for dirname in dirnames:
+            for path, size, mtime, tags in self.db.execute(
+                'SELECT path, size, mtime, tags FROM exif WHERE dir = ?',
+                (dirname,)):
+                entries[path] = (size, mtime, marshal.loads(str(tags)))
+        return entries
+
+    def lookup_path(self, path):
+        """The entry for a single file, in the same form as lookup"""
+        entries = {}
+        row = self.db.execute('SELECT size, mtime, tags FROM exif '
+                              'WHERE path = ?', (path,)).fetchone()
+        if row is not None:
+            entries[path] = (row[0], row[1], marshal.loads(str(row[2])))
+        return entries
+
+    def store(self, entries):
+        """Add (path, size, mtime, tags) entries to the cache"""
+        self.db.executemany('INSERT OR REPLACE INTO exif VALUES (?, ?, ?, ?, ?)',
+                            [(path, os.path.dirname(path), size, mtime,
+                              sqlite3.Binary(marshal.dumps(tags)))
+                             for path, size, mtime, tags in entries])
+        self.db.commit()
+
+    def get_tags(self, paths):
+        """The tags of each file in paths, as a dict of tag key -
+        printable value, for the wanted tags that the file has.
+        Files that are not in the cache, or have changed since, are
+        read (in parallel) and cached. A single file (as when
+        browsing) is looked up on its own, more are looked up by
+        directory"""
+        stats = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                stats[path] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                stats[path] = None
+
+        if len(paths) == 1:
+            cached = self.lookup_path(paths[0])
+        else:
+            cached = self.lookup(set([os.path.dirname(path)
+                                      for path in paths]))
+        tags = {}
+        missing = []
+        for path in paths:
+            entry = cached.get(path)
+            if entry and stats[path] is not None and entry[:2] == stats[path]:
+                tags[path] = entry[2]
+            else:
+                missing.append(path)
+
+        # files without (readable) exif are cached too, with no tags,
+        # so they aren't read again until they change. Only files
+        # that can't be found are left out
+        new_entries = []
+        for path, fields, error in Exifreader.process_files(
+            missing, wanted_tags=self.wanted_tags):
+            tags[path] = fields
+            if stats[path] is not None:
+                new_entries.append((path,) + stats[path] + (fields,))
+        self.store(new_entries)
+
+        return [tags[path] for path in paths]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Raja S
+
+"""Offscreen rendering of the display canvases, without a window or
+a display server. The drawing code of a DisplayCanvas subclass
+(resize_image, draw, get_resize_params, val_to_canvasx, ...) is run
+as it is, but draws on a PIL image, so that rendering can be timed,
+profiled and compared between versions"""
+
+import time
+import Image
+import ImageDraw
+from utils import DisplayCanvas
+
+class OffscreenFont():
+    """Stands in for the dc's font. Text is always drawn with PIL's
+    default font"""
+    def SetPointSize(self, size):
+        pass
+
+
+class OffscreenDC():
+    """The part of the wx.DC interface used by the canvases,
+    drawing on a PIL image. Pens are (colour, width) and brushes
+    colours, as made by OffscreenCanvas"""
+    def __init__(self, image):
+        self.image = image
+        self.draw = ImageDraw.Draw(image)
+        self.pen = ((0, 0, 0), 1)
+        self.brush = (255, 255, 255)
+        self.font = OffscreenFont()
+
+    def Clear(self):
+        self.image.paste((255, 255, 255), (0, 0) + self.image.size)
+
+    def GetFont(self):
+        return self.font
+
+    def SetFont(self, font):
+        self.font = font
+
+    def SetPen(self, pen):
+        self.pen = pen
+
+    def SetBrush(self, brush):
+        self.brush = brush
+
+    def DrawLine(self, x1, y1, x2, y2):
+        colour, width = self.pen
+        self.draw.line([(x1, y1), (x2, y2)], fill=colour, width=width)
+
+    def DrawPoint(self, x, y):
+        self.draw.point((x, y), fill=self.pen[0])
+
+    def DrawRectangle(self, x, y, width, height):
+        self.draw.rectangle([x, y, x + width - 1, y + height - 1],
+                            fill=self.brush, outline=self.pen[0])
+
+    def DrawText(self, text, x, y):
+        self.draw.text((x, y), text, fill=(0, 0, 0))
+
+    def Blit(self, x, y, width, height, source, xsrc, ysrc):
+        """source is the image from OffscreenCanvas.bitmap_dc"""
+        self.image.paste(source.crop((xsrc, ysrc, xsrc + width, ysrc + height)),
+                         (int(x), int(y)))
+
+
+class OffscreenCanvas(object):
+    """Base of the classes made by offscreen_canvas, replacing the
+    parts of DisplayCanvas that need wx"""
+    NEEDREDRAW = False
+
+    def __init__(self, frame=None):
+        self.frame = frame
+        self.NEEDREDRAWFRAME = False
+        self.resized_source = None
+        self.resized_canvas = None
+        self.bitmap_source = None
+        self.bitmap = None
+        self.render_time = None # how long the last render took
+        self.make_tools()
+
+    def resize(self, size):
+        """Change the canvas size, as a size event would"""
+        self.width, self.height = size
+        self.buffer = Image.new('RGB', size, (255, 255, 255))
+        self.layout()
+        self.NEEDREDRAW = True
+
+    def render(self):
+        """Draw the canvas, as DisplayCanvas.redraw does on screen.
+        Returns the image drawn on"""
+        start = time.time()
+        dc = OffscreenDC(self.buffer)
+        dc.Clear()
+        self.draw(dc)
+        self.render_time = time.time() - start
+        self.NEEDREDRAW = False
+        return self.buffer
+
+    def image_to_bitmap(self, img):
+        """The 'bitmap' is the image in RGB"""
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return img
+
+    def bitmap_dc(self, bmp):
+        return bmp
+
+    def make_pen(self, colour, width=1):
+        return colour, width
+
+    def make_brush(self, colour):
+        return colour
+
+
+# offscreen classes already made, by canvas class
+offscreen_classes = {}
+
+def offscreen_class(canvas_class):
+    """A class with the drawing code of canvas_class (a DisplayCanvas
+    subclass) on top of OffscreenCanvas"""
+    if canvas_class not in offscreen_classes:
+        namespace = {}
+        for cls in reversed(canvas_class.__mro__):
+            if issubclass(cls, DisplayCanvas):
+                for name, value in vars(cls).items():
+                    if not name.startswith('__'):
+                        namespace[name] = value
+        # the wx parts are replaced
+        for name in vars(OffscreenCanvas):
+            namespace.pop(name, None)
+        offscreen_classes[canvas_class] = type(
+            'Offscreen' + canvas_class.__name__, (OffscreenCanvas,), namespace)
+    return offscreen_classes[canvas_class]
+
+def offscreen_canvas(canvas_class, size, frame=None, **state):
+    """An offscreen canvas of size (width, height) that draws like
+    canvas_class. frame stands in for the main frame the canvas
+    draws from (frame.im, frame.preview, ...). The canvas' __init__
+    isn't run, so the rest of the state it needs to draw is given as
+    keyword arguments (eg vals, steps and CONTINUOUS for a
+    SubRangeSelect, whose _init_range then has to be called)"""
+    canvas = offscreen_class(canvas_class)(frame)
+    for name in state:
+        setattr(canvas, name, state[name])
+    canvas.resize(size)
+    return canvas
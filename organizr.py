@@ -19,6 +19,7 @@ from subrange_select import SubRangeSelect
 from wx.lib.mixins.listctrl import ListCtrlAutoWidthMixin
 
 from utils import *
+from exifcache import ExifCache
 import overview
 #########################
 # TODO:
@@ -132,6 +133,8 @@ class MainFrame(wx.Frame):
         self.playlist = ['']
         self.nowshowing = 0
         self.trash_folder = '/data/tmp/organizr_trash/'
+        self.exifcache = ExifCache()
+        self.thumbnailer = ThumbnailMaker()
         
     def __do_layout(self):
         self.sizer_1 = wx.BoxSizer(wx.VERTICAL)
@@ -210,6 +213,14 @@ class MainFrame(wx.Frame):
         #self.nb.Bind(wx.EVT_MOUSE_EVENTS, self.playlistcanvas.on_mouse_events)
 
         self.canvas.Bind(wx.EVT_KEY_DOWN, self.on_key_down)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
+    def on_close(self, event):
+        """Stop the thumbnail workers and close the exif cache
+        before the frame goes"""
+        self.thumbnailer.close()
+        self.exifcache.close()
+        self.Destroy()
         
     def onopen(self, event):
         """Open a new file"""
@@ -218,14 +229,20 @@ class MainFrame(wx.Frame):
                           '*.jpg;*.jpeg;*.JPG;*.JPEG',
                           '*.tif;*.tiff;*.TIF;*.TIFF',
                           '*.bmp;*.BMP',
+                          '*.cr2;*.CR2',
                           '|All files|*.*'])
         
         dlg = wx.FileDialog(self, defaultDir = self.CURRENT_DIR,
                             style=wx.OPEN, wildcard=wildcard)
         if dlg.ShowModal() == wx.ID_OK:
             self.filepath = dlg.GetPath()
+            if is_raw(self.filepath):
+                # RAW+ pairs are shown through their JPEG
+                self.filepath = find_jpeg_pair(self.filepath) or self.filepath
             self.CURRENT_DIR = os.path.dirname(self.filepath)
             self.create_playlist()
+            # fill in missing thumbnails while we browse
+            self.thumbnailer.request(self.playlist)
             
             self.nowshowing = self.playlist.index(self.filepath)
             self.load_new()
@@ -239,14 +256,14 @@ class MainFrame(wx.Frame):
         self.COMPOSITE_SELECTED = True
         self.ov.load()
 
-        self.date_select.vals = self.ov.date_vals
+        self.date_select.vals = self.ov.columns.known('time')
         self.date_select._init_range()
         #self.date_select.ticks = []
         #self.date_select.ticklabels = []
         
-        self.aperture_select.vals = self.ov.aperture_vals
-        self.shutter_select.vals = self.ov.shutter_vals
-        self.focal_select.vals = self.ov.focal_vals
+        self.aperture_select.vals = self.ov.columns.known('aperture')
+        self.shutter_select.vals = self.ov.columns.known('shutter')
+        self.focal_select.vals = self.ov.columns.known('focal_length')
         
         self.aperture_select._init_range()
         self.shutter_select._init_range()
@@ -311,8 +328,8 @@ class MainFrame(wx.Frame):
         self.create_playlist()
         self.nowshowing = self.playlist.index(self.filepath)
 
-        self.exifinfo = ExifInfo(open
-                                 (self.playlist[self.nowshowing], 'r'))
+        self.exifinfo = ExifInfo(None, exifdata=self.exifcache.get_tags(
+            [metadata_file(self.playlist[self.nowshowing])])[0])
         self.exifpanel.DeleteAllItems()
         for info in self.exifinfo.exif_info_list:
             index = self.exifpanel.InsertStringItem(sys.maxint, info[0])
@@ -364,15 +381,22 @@ class MainFrame(wx.Frame):
     def create_playlist(self):
         """
         Make a playlist by listing all image files in the directory beginning
-        from the selected file
+        from the selected file.
+        RAW files are only listed if there is no JPEG shot with them
         """
         self.playlist = []
         dirname = os.path.dirname(self.filepath)
         allfiles = os.listdir(dirname)
+        jpeg_names = set([os.path.splitext(eachfile)[0] for eachfile in allfiles
+                          if os.path.splitext(eachfile)[1].lower() in
+                          JPEG_EXTENSIONS])
                 
         for eachfile in allfiles:
-            if os.path.splitext(eachfile)[1].lower() in ['.bmp', '.png',
-                                        '.jpg', '.jpeg', '.tif', '.tiff']:
+            name, ext = os.path.splitext(eachfile)
+            if ext.lower() in ['.bmp', '.png',
+                               '.jpg', '.jpeg', '.tif', '.tiff']:
+                self.playlist.append(os.path.join(dirname, eachfile))
+            elif ext.lower() in RAW_EXTENSIONS and name not in jpeg_names:
                 self.playlist.append(os.path.join(dirname, eachfile))
         self.playlist.sort()
         
@@ -392,23 +416,28 @@ class DateRangeSelector(SubRangeSelect):
 class ApRangeSelector(SubRangeSelect):
     """select range of aperture values"""
     def __init__(self, parent):
-        steps = ['1.4', '1.8', '2.5', '3.5', '3.2', '4', '4.5', '5',
-                      '5.6', '6.3', '7.1', '8', '10', '13', '16', '32']
+        steps = [1.4, 1.8, 2.5, 3.2, 3.5, 4, 4.5, 5,
+                 5.6, 6.3, 7.1, 8, 10, 13, 16, 32]
         SubRangeSelect.__init__(self, parent, steps=steps, CONTINUOUS=False)
         
 class ShutRangeSelector(SubRangeSelect):
     """Selecte range of shutter times"""
     def __init__(self, parent):
-        steps = ['1/1000', '1/800', '1/500', '1/400', '1/320',
-                      '1/250', '1/200', '1/160', '1/125', '1/100', '1/80', '1/60',
-                      '1/50', '1/40', '1/30', '1/20', '1/15', '1/10', '1/5', '1', '5']
+        steps = [1 / speed for speed in [1000, 800, 500, 400, 320,
+                      250, 200, 160, 125, 100, 80, 60,
+                      50, 40, 30, 20, 15, 10, 5]] + [1, 5]
         SubRangeSelect.__init__(self, parent, steps=steps, CONTINUOUS=False)
 
+    def step_label(self, step):
+        """times under a second as fractions"""
+        if step < 1:
+            return '1/%d' % (round(1 / step))
+        return '%d' % (step)
     
 class FocRangeSelector(SubRangeSelect):
     """Select range of focal lengths"""
     def __init__(self, parent):
-        steps = ['17', '30', '50', '70', '100', '200', '300']
+        steps = [17, 30, 50, 70, 100, 200, 300]
         SubRangeSelect.__init__(self, parent, steps=steps, CONTINUOUS=False)
 
         
@@ -430,10 +459,13 @@ class ImageCanvas(DisplayCanvas):
     def resize_image(self):
         """Process the image by resizing to best fit current size"""
         if self.frame.COMPOSITE_SELECTED:
-            self.resizedimage = self.frame.ov.image.copy()
+            image = self.frame.ov.image
         else:
-            self.resizedimage = self.frame.im.image.copy()
+            image = self.frame.im.image
+        if not self.needs_resize(image):
+            return # still showing it
 
+        self.resizedimage = image.copy()
         self.resizedimage.thumbnail((self.width, self.height), Image.NEAREST)
         self.resized_width, self.resized_height = self.resizedimage.size
         self.xoffset = (self.width-self.resized_width)/2
@@ -442,8 +474,7 @@ class ImageCanvas(DisplayCanvas):
         # blit the image centerd in x and y axes
         self.bmp = self.image_to_bitmap(self.resizedimage)
 
-        self.imagedc = wx.MemoryDC()
-        self.imagedc.SelectObject(self.bmp)
+        self.imagedc = self.bitmap_dc(self.bmp)
 
     def draw(self, dc):
         """Redraw the image"""
@@ -466,6 +497,8 @@ class PlayListCanvas(DisplayCanvas):
     def resize_image(self):
         """Process the image by resizing to best fit current size"""
         image = self.frame.preview.composite
+        if not self.needs_resize(image):
+            return # still showing it
         imagewidth, imageheight = image.size
 
         self.get_resize_params(imagewidth, imageheight)
@@ -475,8 +508,7 @@ class PlayListCanvas(DisplayCanvas):
         # blit the image centerd in x and y axes
         self.bmp = self.image_to_bitmap(self.resizedimage)
 
-        self.imagedc = wx.MemoryDC()
-        self.imagedc.SelectObject(self.bmp)
+        self.imagedc = self.bitmap_dc(self.bmp)
 
     def draw(self, dc):
         """Redraw the image"""
@@ -506,7 +538,6 @@ class ThumbnailCanvas(DisplayCanvas):
 	"""
         DisplayCanvas.__init__(self, parent)
         self.frame = wx.GetTopLevelParent(self)
-        self.pen = wx.Pen(wx.WHITE, 2, wx.SOLID)
         self.Bind(wx.EVT_MOUSE_EVENTS, self.on_mouse_events)
 
         self.oldx1 = 0; self.oldx2 = 0
@@ -517,10 +548,17 @@ class ThumbnailCanvas(DisplayCanvas):
         self.startdrag = False
         self.firstdraw = True
 
+    def make_tools(self):
+        """pen for the zoom frame"""
+        self.pen = self.make_pen((255, 255, 255), 2)
         
     def resize_image(self):
         """Process the image by resizing to best fit current size"""
-        self.resizedimage = self.frame.im.original_image.copy()
+        image = self.frame.im.original_image
+        if not self.needs_resize(image):
+            return # still showing it
+
+        self.resizedimage = image.copy()
         self.resizedimage.thumbnail((self.width, self.height), Image.NEAREST)
         self.resized_width, self.resized_height = self.resizedimage.size
         self.xoffset = int((self.width-self.resized_width)/2)
@@ -529,8 +567,7 @@ class ThumbnailCanvas(DisplayCanvas):
         # blit the image centerd in x and y axes
         self.bmp = self.image_to_bitmap(self.resizedimage)
 
-        self.imagedc = wx.MemoryDC()
-        self.imagedc.SelectObject(self.bmp)
+        self.imagedc = self.bitmap_dc(self.bmp)
 
     def on_mouse_events(self, event):
         """Handle mouse events.
@@ -781,16 +818,15 @@ class SeriesPreview():
     def build_composite(self):
         """Build a composite image with thumbnails of the images."""
         self.im_list = []
+        self.tb_sources = [] # where each thumbnail came from
         for filename in self.filenames:
-            # get thumbnail from nautilus store if possible
-            tb_file = get_thumbnailfile(filename)
-            if tb_file:
-                self.im_list.append(Image.open(tb_file))
-            else:
-                try:
-                    self.im_list.append(Image.open(filename))
-                except:
-                    self.im_list.append(self.blankimage)
+            # cheapest thumbnail available (nautilus store, exif, image)
+            try:
+                tb, source = load_thumbnail(filename, self.tn_size)
+            except:
+                tb, source = self.blankimage, 'blank'
+            self.im_list.append(tb)
+            self.tb_sources.append(source)
 
         # resize
         self.thumbnails = self.im_list
@@ -838,7 +874,7 @@ class Im():
         stime = time.time()
         filepath = self.frame.playlist[self.frame.nowshowing]
         try:
-            self.original_image = Image.open(filepath, 'r')
+            self.original_image = open_image(filepath)
         except:
             self.frame.SetStatusText('Could not load image')
             return
@@ -863,7 +899,9 @@ class Im():
         self.frame.canvas.NEEDREDRAW = True
         self.frame.thumbnailpanel.NEEDREDRAW = True
         status_string = os.path.basename(filepath)
-        if os.path.exists(os.path.splitext(filepath)[0] + '.CR2'):
+        if is_raw(filepath):
+            status_string += ' : RAW'
+        elif os.path.exists(os.path.splitext(filepath)[0] + '.CR2'):
             status_string += ' : RAW+'
         self.frame.SetStatusText(status_string)
 
@@ -7,10 +7,57 @@ with a composite showing all thumbnails and filtering
 based on exif info"""
 
 from __future__ import division
-from organizr import get_thumbnailfile
+import os
 import Image
-import datetime
-from utils import ExifInfo, reduce_fraction, relative_time, in_range
+import numpy
+from utils import ExifInfo, metadata_file, list_to_hist
+from atlas import ThumbnailAtlas
+
+# the tags that the overview filters on (the cache holds these
+# along with the rest of utils.EXIF_INFO_TAGS)
+OVERVIEW_TAGS = ['Image DateTime', 'EXIF DateTimeOriginal', 'EXIF FNumber',
+                 'EXIF ExposureTime', 'EXIF FocalLength']
+
+class ExifColumns():
+    """The typed exif information (ExifInfo.record) of all the images
+    in a playlist, held as one numpy array per field, indexed like
+    the playlist. valid[field] masks out the images that don't have
+    that field"""
+    FIELDS = ['time', 'aperture', 'shutter', 'focal_length', 'iso']
+
+    def __init__(self, records):
+        """records is a sequence of ExifInfo.record dicts"""
+        columns = dict([(field, []) for field in self.FIELDS])
+        for record in records:
+            for field in self.FIELDS:
+                columns[field].append(record[field])
+
+        self.values = {}
+        self.valid = {}
+        for field in self.FIELDS:
+            column = columns.pop(field)
+            self.valid[field] = numpy.array([val is not None
+                                             for val in column], dtype=bool)
+            self.values[field] = numpy.array([val or 0 for val in column],
+                                             dtype=float)
+
+    def __len__(self):
+        return len(self.values['time'])
+
+    def known(self, field):
+        """The values of field for the images that have it"""
+        return self.values[field][self.valid[field]]
+
+    def selected(self, field, range, select=None):
+        """Mask of the images whose field is within range. For
+        discrete range selectors the range is of step indices.
+        Images are not filtered on values they don't have"""
+        values = self.values[field]
+        if select is not None:
+            values = select.indexify_all(values)
+        return ((values >= range[0]) & (values <= range[1])) | \
+               ~self.valid[field]
+
 
 class Overview():
     def __init__(self, parent, playlist):
@@ -21,40 +68,40 @@ class Overview():
 
         self.sub_playlist = self.playlist # selected images only
         self.get_exifinfo()
+        self.get_thumbnails()
         
     def get_exifinfo(self):
         """For all files in playlist get the exif information"""
-        # load all exif info
-        self.exifdata = []
+        # load all exif info, from the frame's cache where possible
+        tags = self.frame.exifcache.get_tags(
+            [metadata_file(filename) for filename in self.playlist])
+        self.columns = ExifColumns(
+            [ExifInfo(None, OVERVIEW_TAGS, exifdata=file_tags).record
+             for file_tags in tags])
+
+    def get_thumbnails(self):
+        """Bring the thumbnail atlas of each directory in the
+        playlist up to date"""
+        dirs = {}
         for filename in self.playlist:
-            exif_data = ExifInfo(open
-                            (filename, 'r'))
-            self.exifdata.append(exif_data.info)
-
-        date_vals = [data.get('DateTime', '-1') for data in self.exifdata]
-        self.aperture_vals = [reduce_fraction(data.get('FNumber', '-1'))
-                              for data in self.exifdata]
-        self.shutter_vals = [data.get('ExposureTime', '-1') for data in self.exifdata]
-        self.focal_vals = [data.get('FocalLength', '-1') for data in self.exifdata]
-
-        date_vals = [datetime.datetime.strptime(val, '%Y:%m:%d %H:%M:%S')
-                     for val in date_vals if val != '-1']
-        self.date_vals = [relative_time(date_val) for date_val in date_vals]
-
+            dirs.setdefault(os.path.dirname(filename), []).append(filename)
+        self.atlases = {}
+        for dirname in dirs:
+            self.atlases[dirname] = ThumbnailAtlas(dirname, self.tn_size)
+            self.atlases[dirname].update(dirs[dirname])
 
     def rebuild_subplaylist(self, date_range,
                             aperture_range, shutter_range, focal_range):
         """Narrow down the selected images in the playlist"""
-        aperture_steps = self.frame.aperture_select.steps
-        shutter_steps = self.frame.shutter_select.steps
-        focal_steps = self.frame.focal_select.steps
-        
-        self.sub_playlist = [self.playlist[ind] for ind in range(len(self.playlist)) if
-                in_range(self.date_vals[ind], date_range) and
-                in_range(aperture_steps.index(self.aperture_vals[ind]),
-                         aperture_range) and
-                in_range(shutter_steps.index(self.shutter_vals[ind]), shutter_range) and
-                in_range(focal_steps.index(self.focal_vals[ind]), focal_range)]
+        selected = self.columns.selected('time', date_range) & \
+                   self.columns.selected('aperture', aperture_range,
+                                         self.frame.aperture_select) & \
+                   self.columns.selected('shutter', shutter_range,
+                                         self.frame.shutter_select) & \
+                   self.columns.selected('focal_length', focal_range,
+                                         self.frame.focal_select)
+        self.sub_playlist = [self.playlist[ind]
+                             for ind in numpy.flatnonzero(selected)]
 
         
     def build_composite(self):
@@ -76,21 +123,16 @@ class Overview():
                                            (self.tn_size + 10) * (rows + 1)),
                                            (255, 255, 255))
         # loop thro each pic and add it
+        self.tb_sources = [] # where each thumbnail came from
         index = 0
         for r in range(rows+1):
             for c in range(cols):
                 if index == len(self.sub_playlist):
                     break
                 filename = self.sub_playlist[index]
-                tb_file = get_thumbnailfile(filename)
-                if not tb_file:
-                    try:
-                        print 'no stored tb'
-                        tb = Image.open(filename)
-                    except:
-                        tb = self.blankimage
-                else:
-                    tb = Image.open(tb_file)
+                tb, source = self.atlases[os.path.dirname(filename)].get(
+                    filename) or (self.blankimage, 'blank')
+                self.tb_sources.append(source)
                         
                 x1 = 5 + c * (self.tn_size + 10)
                 y1 = 5 + r * (self.tn_size + 10) 
@@ -117,6 +159,11 @@ class Overview():
         self.frame.canvas.NEEDREDRAW = True
         status_string = "composite"
         self.frame.SetStatusText(status_string)
+        # report where the thumbnails came from
+        sources = list_to_hist(self.tb_sources)
+        self.frame.SetStatusText('thumbnails: ' + ', '.join(
+            ['%s %d' % (source, sources[source])
+             for source in sorted(sources)]), 1)
         
 def test():
     overview = Overview(None, range(63))
@@ -5,7 +5,8 @@ from __future__ import division
 import wx
 import time
 import math
-from utils import DisplayCanvas, list_to_hist, in_rectangle
+import numpy
+from utils import DisplayCanvas, in_rectangle
 
 
 class SubRangeSelect(DisplayCanvas):
@@ -22,24 +23,23 @@ class SubRangeSelect(DisplayCanvas):
         self.CONTINUOUS = CONTINUOUS
         self.border = 20
 
-        # brushes and pens
-        self.range_brush = wx.Brush((200, 200, 200), wx.SOLID)
-        self.subrange_brush = wx.Brush((100, 100, 100), wx.SOLID)
-        self.tick_pen = wx.Pen(wx.BLACK, 1, wx.SOLID)
-
-        if vals != []:
+        if len(vals):
             self._init_range() #call if vals and steps changes
 
         self.on_resize(None)
         self.Bind(wx.EVT_MOUSE_EVENTS, self.on_mouse)
                 
-    def on_resize(self, event):
-            """when canvas  is resized, we create a new buffer, which will
-            be redrawn on next idle event. This is also the ideal time to
-            update the size of the range rectangle and the bounding box"""
-            # update / initialize height and width
-            self.width, self.height = self.GetSize()
-
+    def make_tools(self):
+        """brushes and pens"""
+        self.range_brush = self.make_brush((200, 200, 200))
+        self.subrange_brush = self.make_brush((100, 100, 100))
+        self.tick_pen = self.make_pen((0, 0, 0))
+        self.vals_pen = self.make_pen((255, 0, 0), 2)
+        self.vals_brush = self.make_brush((255, 0, 0))
+
+    def layout(self):
+            """when canvas  is resized, update the size of the range
+            rectangle and the bounding box"""
             # update size of rectangle
             self.rect_ht = self.height // 5
             self.rect_wd = self.width - 2 * self.border
@@ -50,15 +50,12 @@ class SubRangeSelect(DisplayCanvas):
                          self.width - self.border,
                          self.height - self.border)
 
-            # update / create the buffer for the buffered dc
-            image = wx.EmptyImage(self.width, self.height)
-            wx.Image.Create(image, self.width, self.height, False)
-            wx.Image.SetRGBRect(image, wx.Rect(0, 0, self.width, self.height),
-                                255, 255, 255)        
-            self.buffer = wx.BitmapFromImage(image)
-
-            if self.vals != []:
-                self.NEEDREDRAW = True
+    def settle_resize(self):
+        """The resizing is over, redraw if there is anything to show"""
+        self.resize_timer = None
+        self.resize_buffer()
+        if len(self.vals):
+            self.NEEDREDRAW = True
 
     def on_mouse(self, event):
         """handle mouse events"""
@@ -107,18 +104,34 @@ class SubRangeSelect(DisplayCanvas):
         self.range_max = new_x2
 
     def indexify(self, val):
-        """convert val to index in discrete ranges"""
-        try:
+        """convert val to index in discrete ranges.
+        Numbers go to the nearest step"""
+        if val in self.steps:
             return self.steps.index(val)
-        except ValueError:
+        try:
+            return min(range(len(self.steps)),
+                       key=lambda ind: abs(self.steps[ind] - val))
+        except (TypeError, ValueError):
             return -1
+
+    def indexify_all(self, vals):
+        """indexify a whole array of vals. For numeric steps
+        this is done in one go"""
+        try:
+            steps = numpy.array(self.steps, dtype=float)
+            vals = numpy.asarray(vals, dtype=float)
+        except (TypeError, ValueError):
+            return numpy.array([self.indexify(val) for val in vals], dtype=int)
+        if len(steps) == 0:
+            return numpy.zeros(len(vals), dtype=int) - 1
+        return numpy.abs(vals[:, numpy.newaxis] - steps).argmin(axis=1)
         
     def _init_range(self):
         """Initialise range limits from vals / steps.
         For discrete vals, also convert vals to indices"""
         if self.CONTINUOUS:
-            self.val_min = min(self.vals)
-            self.val_max = max(self.vals)
+            self.val_min = numpy.min(self.vals)
+            self.val_max = numpy.max(self.vals)
             buffer_width = (self.val_max - self.val_min) / 10
 
             self.range_min = self.val_min - buffer_width
@@ -130,13 +143,14 @@ class SubRangeSelect(DisplayCanvas):
             self.range_min = -0.5
             self.range_max = len(self.steps)-0.5
 
-            self.vals = [self.indexify(val)
-                         for val in self.vals]
+            self.vals = self.indexify_all(self.vals)
             
             self.subrange_min = self.range_min + 0.5
             self.subrange_max = self.range_max - 0.5
 
-        self.vals_hist = list_to_hist(self.vals)
+        # count of each distinct value
+        hist_vals, counts = numpy.unique(self.vals, return_counts=True)
+        self.vals_hist = dict(zip(hist_vals.tolist(), counts.tolist()))
         self.full_range = (self.range_min, self.range_max)
         
     def val_to_canvasx(self, val):
@@ -197,8 +211,8 @@ class SubRangeSelect(DisplayCanvas):
             ticks = [self.range_min + interval * (multiple + 1)
                      for multiple in range(4)]
         else:
-            # range_min and max are always integers, interval is always 1
-            ticks = range(self.range_min+1, self.range_max+1)
+            # range_min and max are half way between steps, interval is 1
+            ticks = range(int(self.range_min+1), int(self.range_max+1))
 
         ticklabels = [self.format_val(tick) for tick in ticks]
         tickpos = [self.val_to_canvasx(tick) for tick in ticks]
@@ -243,8 +257,8 @@ class SubRangeSelect(DisplayCanvas):
     def draw_vals(self, dc):
         """Draw the individual values.
         Self.vals is already in the histogram format"""
-        dc.SetPen(wx.Pen(wx.RED, 2, wx.SOLID))
-        dc.SetBrush(wx.Brush(wx.RED, wx.SOLID))
+        dc.SetPen(self.vals_pen)
+        dc.SetBrush(self.vals_brush)
         y1 = self.height - self.border - self.rect_ht/10
 
         for val in self.vals_hist:
@@ -278,14 +292,18 @@ class SubRangeSelect(DisplayCanvas):
         else:
             # can format differently based on min/max/neither
             if min:
-                return self.steps[int(math.ceil(val))]
+                return self.step_label(self.steps[int(math.ceil(val))])
             elif max:
-                return self.steps[int(val)]
+                return self.step_label(self.steps[int(val)])
             else:
                 if val < 0 or int(val) != val:
                     return ''
                 else:
-                    return self.steps[int(val)]
+                    return self.step_label(self.steps[int(val)])
+
+    def step_label(self, step):
+        """How a step of a discrete range is shown"""
+        return '%s' % (step)
 
     def get_selection(self):
         """return the limits of the selected subrange"""
@@ -1,10 +1,57 @@
 
 import os
+import time
+import urllib
 import hashlib
 import wx
 import datetime
+import cStringIO
+import multiprocessing
+import Image
+import PngImagePlugin
 import Exifreader
 
+# RAW formats we can display (via their embedded preview)
+RAW_EXTENSIONS = ['.cr2']
+JPEG_EXTENSIONS = ['.jpg', '.jpeg']
+
+# freedesktop thumbnail store, and the size of the thumbnails
+# in each of its directories
+THUMBNAIL_DIR = os.path.expanduser('~/.thumbnails')
+THUMBNAIL_SIZES = {'normal': 128, 'large': 256}
+
+# the most times a second that the display canvases are redrawn
+REDRAW_FPS = 60
+# a resized canvas is redrawn when no size event has come for this
+# long (ms), till then the last frame is stretched over it
+RESIZE_SETTLE = 200
+# canvas buffers are allocated in multiples of this, as headroom
+BUFFER_STEP = 256
+
+# exif tags needed for the information ExifInfo extracts
+EXIF_INFO_TAGS = ['Image Model', 'Image Orientation', 'Image DateTime',
+                  'EXIF DateTimeOriginal', 'EXIF ExposureTime',
+                  'EXIF FNumber', 'EXIF FocalLength', 'EXIF ISOSpeedRatings',
+                  'MakerNote ExposureMode', 'MakerNote FlashMode',
+                  'MakerNote LongFocalLengthOfLensInFocalUnits',
+                  'MakerNote ShortFocalLengthOfLensInFocalUnits']
+
+# the information ExifInfo extracts, each with the tags it is
+# read from in order of preference
+EXIF_INFO_KEYS = [('Model', ['Image Model']),
+                  ('Orientation', ['Image Orientation']),
+                  ('DateTime', ['EXIF DateTimeOriginal', 'Image DateTime']),
+                  ('ExposureMode', ['MakerNote ExposureMode']),
+                  ('ExposureTime', ['EXIF ExposureTime']),
+                  ('FNumber', ['EXIF FNumber']),
+                  ('FocalLength', ['EXIF FocalLength']),
+                  ('FlashMode', ['MakerNote FlashMode']),
+                  ('ISOSpeed', ['EXIF ISOSpeedRatings']),
+                  ('LongFocalLengthOfLens',
+                   ['MakerNote LongFocalLengthOfLensInFocalUnits']),
+                  ('ShortFocalLengthOfLens',
+                   ['MakerNote ShortFocalLengthOfLensInFocalUnits'])]
+
 # utility functions
 
 def relative_time(timeobj, dawnoftime=None):
@@ -31,18 +78,278 @@ def reduce_fraction(fraction_string):
         reduced_string = '%s' % (fraction_string)
     return reduced_string
 
+def fraction_value(fraction_string):
+    """The value of a string holding a number or a fraction,
+    as a float. None if it can't be worked out.
+    ex: input '71/10' gives 7.1"""
+    try:
+        if '/' in fraction_string:
+            num, den = fraction_string.split('/')
+            return float(num) / float(den)
+        return float(fraction_string)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+def int_value(int_string):
+    """The value of a string holding an integer, None if it
+    can't be worked out"""
+    try:
+        return int(int_string)
+    except (TypeError, ValueError):
+        return None
+
+def exif_time_value(time_string):
+    """Convert an exif date and time string to seconds
+    since 01-01-1970. None if it can't be worked out"""
+    try:
+        return relative_time(datetime.datetime.strptime(
+            time_string, '%Y:%m:%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+def thumbnail_uri(filename):
+    """The URI that the thumbnails of filename are stored under.
+    Like other freedesktop thumbnailers, the path is %-escaped
+    (spaces, non ascii characters, ...)"""
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    return 'file://' + urllib.quote(os.path.abspath(filename),
+                                    safe="/!$&'()*+,:=@~")
+
+def thumbnail_path(filename, size='normal'):
+    """Where the freedesktop thumbnail of filename, of the given
+    size ('normal' or 'large'), is stored"""
+    file_hash = hashlib.md5(thumbnail_uri(filename)).hexdigest()
+    return os.path.join(THUMBNAIL_DIR, size, file_hash) + '.png'
+
+def thumbnail_mtime(tb_filename):
+    """The mtime (Thumb::MTime) of the file that a thumbnail was
+    made from, None if the thumbnail can't be read"""
+    try:
+        return Image.open(tb_filename).info.get('Thumb::MTime')
+    except IOError:
+        return None
+
+class ThumbnailIndex():
+    """The thumbnails in one directory of the freedesktop store,
+    kept as a set of hashes so that looking up a thumbnail needs no
+    more than a stat of the image. The directory is only listed again
+    when its mtime has changed, which is checked at most once a
+    second, and what is known about the thumbnails that are still
+    there is kept"""
+    def __init__(self, size='normal'):
+        self.dirname = os.path.join(THUMBNAIL_DIR, size)
+        self.dir_mtime = None
+        self.checked = 0 # when the directory mtime was last checked
+        self.hashes = set()
+        self.file_hashes = {} # filename - hash of its uri
+        # hash - (Thumb::MTime, dir_mtime when it was read)
+        self.thumb_mtimes = {}
+
+    def refresh(self):
+        """List the thumbnail directory again if it has changed"""
+        now = time.time()
+        if now - self.checked < 1:
+            return
+        self.checked = now
+        try:
+            dir_mtime = os.stat(self.dirname).st_mtime
+        except OSError:
+            dir_mtime = None
+        if dir_mtime == self.dir_mtime:
+            return
+        self.dir_mtime = dir_mtime
+        if dir_mtime is None:
+            hashes = set()
+        else:
+            hashes = set([name[:-4] for name in os.listdir(self.dirname)
+                          if name.endswith('.png')])
+        for file_hash in self.hashes - hashes:
+            self.thumb_mtimes.pop(file_hash, None)
+        self.hashes = hashes
+
+    def source_mtime(self, filename):
+        """The mtime of filename, as thumbnails have it. It is looked
+        at every time, a file rewritten in place doesn't change the
+        mtime of its directory"""
+        try:
+            return str(int(os.path.getmtime(filename)))
+        except OSError:
+            return None
+
+    def get(self, filename):
+        """The thumbnail of filename, if there is one that was made
+        from the file as it is now (thumbnails carry the mtime of the
+        file they were made from)"""
+        file_hash = self.file_hashes.get(filename)
+        if file_hash is None:
+            file_hash = hashlib.md5(thumbnail_uri(filename)).hexdigest()
+            self.file_hashes[filename] = file_hash
+        if file_hash not in self.hashes:
+            return None
+
+        tb_filename = os.path.join(self.dirname, file_hash) + '.png'
+        mtime = self.source_mtime(filename)
+        known = self.thumb_mtimes.get(file_hash)
+        # a thumbnail that is out of date is read again once the
+        # directory changes, it may have been made again since
+        if known is None or \
+               (known[0] != mtime and known[1] != self.dir_mtime):
+            known = (thumbnail_mtime(tb_filename), self.dir_mtime)
+            self.thumb_mtimes[file_hash] = known
+        if mtime is not None and known[0] == mtime:
+            return tb_filename
+        return None
+
+# one index for each thumbnail size, made when first needed
+thumbnail_indexes = {}
 
-def get_thumbnailfile(filename):
+def get_thumbnailfile(filename, size='normal'):
     """for any image filename, find the stored thumbnail.
     As per free desktop specifications, this is stored in
-    the .thumbnails dir in the home directory"""
-    file_hash = hashlib.md5('file://'+filename).hexdigest()
-    tb_filename = os.path.join(os.path.expanduser('~/.thumbnails/normal'),
-                               file_hash) + '.png'
-    if os.path.exists(tb_filename):
-        return tb_filename
+    the .thumbnails dir in the home directory.
+    Thumbnails of an older version of the file are not used"""
+    if size not in thumbnail_indexes:
+        thumbnail_indexes[size] = ThumbnailIndex(size)
+    index = thumbnail_indexes[size]
+    index.refresh()
+    return index.get(filename)
+
+def load_thumbnail(filename, size=None):
+    """Get a thumbnail for an image as cheaply as possible.
+    The freedesktop thumbnail store is tried first, then the
+    thumbnail embedded in the exif header, and the full image is
+    only decoded as a last resort (at reduced resolution if the
+    size the thumbnail is wanted at is given).
+    Returns the image and its source - 'freedesktop', 'exif' or 'full'"""
+    tb_file = get_thumbnailfile(filename)
+    if tb_file:
+        return Image.open(tb_file), 'freedesktop'
+
+    try:
+        exifdata = Exifreader.process_file(open(metadata_file(filename), 'rb'),
+                                           wanted_tags=['JPEGThumbnail'])
+        tb = Image.open(cStringIO.StringIO(exifdata['JPEGThumbnail'].view()))
+        tb.load()
+        return tb, 'exif'
+    except (Exifreader.ExifError, KeyError, IOError):
+        pass # no usable embedded thumbnail
+
+    return open_image(filename, size), 'full'
+
+def is_raw(filename):
+    """Is this a RAW file"""
+    return os.path.splitext(filename)[1].lower() in RAW_EXTENSIONS
+
+def find_jpeg_pair(filename):
+    """For a RAW file shot in RAW+ mode, return the filename of
+    the JPEG shot with it, or None if there is none"""
+    base = os.path.splitext(filename)[0]
+    for ext in JPEG_EXTENSIONS:
+        for jpeg in [base + ext, base + ext.upper()]:
+            if os.path.exists(jpeg):
+                return jpeg
+    return None
+
+def metadata_file(filename):
+    """The file to read exif information for filename from.
+    For RAW+ pairs this is the JPEG, whose small exif header is
+    much cheaper to read than the RAW"""
+    if is_raw(filename):
+        return find_jpeg_pair(filename) or filename
+    return filename
+
+def open_image(filename, size=None):
+    """Open an image file with PIL. RAW files are not developed,
+    instead the full size JPEG preview embedded in them is decoded.
+    If size is given, the image is only needed to fit in size x size,
+    and JPEGs are decoded at 1/2, 1/4 or 1/8 scale where that is
+    still big enough"""
+    if is_raw(filename):
+        preview = Exifreader.extract_cr2_preview(open(filename, 'rb'))
+        if preview is None:
+            raise IOError('No embedded preview in %s' % (filename))
+        image = Image.open(cStringIO.StringIO(preview))
     else:
-        return None
+        image = Image.open(filename)
+    if size:
+        image.draft('RGB', (size, size))
+    return image
+
+def make_thumbnails(filename):
+    """Create the freedesktop thumbnails, large and normal, for
+    an image file. This is run by the ThumbnailMaker's workers.
+    Files that already have an up to date thumbnail are left alone.
+    Returns the filename and whether it worked"""
+    try:
+        mtime = str(int(os.path.getmtime(filename)))
+        if thumbnail_mtime(thumbnail_path(filename)) == mtime:
+            return filename, True
+
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Thumb::URI', thumbnail_uri(filename))
+        info.add_text('Thumb::MTime', mtime)
+        info.add_text('Software', 'Organizr')
+
+        image = open_image(filename, THUMBNAIL_SIZES['large'])
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        # large first, the normal one is shrunk from it
+        for size in ['large', 'normal']:
+            image.thumbnail((THUMBNAIL_SIZES[size], THUMBNAIL_SIZES[size]),
+                            Image.ANTIALIAS)
+            tb_filename = thumbnail_path(filename, size)
+            try:
+                os.makedirs(os.path.dirname(tb_filename), 0700)
+            except OSError:
+                pass # already there
+            # written under another name and renamed, so that
+            # nobody ever reads half a thumbnail
+            tmp_filename = '%s.%d.tmp' % (tb_filename, os.getpid())
+            image.save(tmp_filename, 'PNG', pnginfo=info)
+            os.chmod(tmp_filename, 0600)
+            os.rename(tmp_filename, tb_filename)
+    except Exception:
+        return filename, False
+    return filename, True
+
+class ThumbnailMaker():
+    """Creates the missing freedesktop thumbnails of image files
+    in the background, using a pool of worker processes"""
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.pool = None # started when first needed
+        self.requested = set()
+
+    def request(self, filenames):
+        """Queue up thumbnails for filenames. Which of them already
+        have an up to date one is left to the workers to find out, so
+        that a big folder doesn't hold up the user interface"""
+        new = [filename for filename in filenames
+               if filename not in self.requested]
+        if not new:
+            return
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        self.requested.update(new)
+        self.pool.map_async(make_thumbnails, new, chunksize=16,
+                            callback=self.made)
+
+    def made(self, results):
+        """Called (in the pool's result thread) when a request is done.
+        Files whose thumbnails couldn't be made can be requested again"""
+        for filename, success in results:
+            if not success:
+                self.requested.discard(filename)
+
+    def close(self):
+        """Stop the workers, dropping the thumbnails still queued so
+        that closing doesn't wait for them. A thumbnail cut short is
+        never seen, it is written to a temporary file and renamed"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
 
 def in_rectangle((x,y), (x1, y1, x2, y2)):
     """is the point (x,y) within the rectangle whose
@@ -72,51 +379,182 @@ def in_range(item, range):
     """Is item within the range"""
     return range[0] <= item <= range[1]
 
+class RedrawScheduler():
+    """Redraws the display canvases that need it, all in one go and
+    at most fps times a second. However often a canvas is marked in
+    between, it is drawn once, in its latest state"""
+    def __init__(self, fps=REDRAW_FPS):
+        self.set_fps(fps)
+        self.dirty = [] # canvases to redraw, in the order they were marked
+        self.last_frame = 0
+        self.next_frame = None # wx.CallLater for the next frame
+
+    def set_fps(self, fps):
+        self.frame_time = 1.0 / fps
+
+    def invalidate(self, canvas):
+        """Redraw canvas in the next frame"""
+        if canvas not in self.dirty:
+            self.dirty.append(canvas)
+        if self.next_frame is None:
+            wait = self.last_frame + self.frame_time - time.time()
+            self.next_frame = wx.CallLater(max(1, int(wait * 1000)),
+                                           self.render_frame)
+
+    def render_frame(self):
+        """Redraw the canvases. Those marked while drawing (eg the
+        image canvas when the thumbnail's zoom frame moves) are left
+        for the next frame"""
+        self.next_frame = None
+        self.last_frame = time.time()
+        dirty, self.dirty = self.dirty, []
+        for canvas in dirty:
+            if canvas: # not destroyed since
+                canvas.redraw()
+
+redraw_scheduler = RedrawScheduler()
+
 class DisplayCanvas(wx.Panel):
-    """A panel that can be subclassed and used for displaying images"""
+    """A panel that can be subclassed and used for displaying images.
+    Setting NEEDREDRAW has the canvas redrawn in the next frame of
+    the redraw_scheduler"""
     def __init__(self, parent, **kwargs):
         wx.Panel.__init__(self, parent, -1, **kwargs)
 
+        self.buffer = None # made on the first size event
+        self.resize_timer = None # wx.CallLater while resizing
+        self.drawn_size = None # canvas size of the last frame drawn
         self.NEEDREDRAW = False
         self.NEEDREDRAWFRAME = False
+        self.resized_source = None # image last resized for the canvas
+        self.resized_canvas = None # and the canvas size it was for
+        self.bitmap_source = None # image the last bitmap was made from
+        self.bitmap = None
+        self.make_tools()
         self.Bind(wx.EVT_SIZE, self.on_resize)
-        self.Bind(wx.EVT_IDLE, self.on_idle)
         self.Bind(wx.EVT_PAINT, self.on_paint) 
 
-    def on_idle(self, event):
-        """Redraw if there is a change"""
-        if self.NEEDREDRAW:
+    def _get_needredraw(self):
+        return self._needredraw
+
+    def _set_needredraw(self, value):
+        self._needredraw = value
+        if value:
+            redraw_scheduler.invalidate(self)
+
+    NEEDREDRAW = property(_get_needredraw, _set_needredraw)
+
+    def redraw(self):
+        """Redraw if there is a change. Called by the redraw_scheduler.
+        While the canvas is being resized, it waits for settle_resize"""
+        if self.NEEDREDRAW and self.buffer is not None and \
+               self.resize_timer is None:
             dc = wx.BufferedDC(wx.ClientDC(self), self.buffer,
                                wx.BUFFER_CLIENT_AREA)
             dc.Clear()  #clear old image if still there        
             self.draw(dc)
+            self.drawn_size = (self.width, self.height)
             self.NEEDREDRAW = False
 
+    def needs_resize(self, image):
+        """Is image not the one that was last resized for the canvas
+        at its current size. It is remembered for the next time"""
+        if image is self.resized_source and \
+               self.resized_canvas == (self.width, self.height):
+            return False
+        self.resized_source = image
+        self.resized_canvas = (self.width, self.height)
+        return True
+
     def image_to_bitmap(self, img):
-        newimage = apply(wx.EmptyImage, img.size)
-        try:
-            newimage.SetData(img.convert( "RGB").tostring())
-        except:
-            pass # TODO: only fordebugging 
-        bmp = newimage.ConvertToBitmap()
-        return bmp
+        """Make a wx bitmap from the RGB data of a PIL image (only
+        converted if it is in another mode). The bitmap
+        is reused while the same image is drawn again"""
+        if img is self.bitmap_source:
+            return self.bitmap
+        rgb_img = img
+        if rgb_img.mode != 'RGB':
+            rgb_img = rgb_img.convert('RGB')
+        width, height = rgb_img.size
+        # still two copies - PIL can't lend its pixels, so tostring()
+        # makes a string of them, which the bitmap copies in turn
+        self.bitmap = wx.BitmapFromBuffer(width, height, rgb_img.tostring())
+        self.bitmap_source = img
+        return self.bitmap
+
+    def bitmap_dc(self, bmp):
+        """A dc to blit bmp from"""
+        dc = wx.MemoryDC()
+        dc.SelectObject(bmp)
+        return dc
+
+    def make_pen(self, colour, width=1):
+        return wx.Pen(wx.Colour(*colour), width, wx.SOLID)
+
+    def make_brush(self, colour):
+        return wx.Brush(wx.Colour(*colour), wx.SOLID)
 
     def on_resize(self, event):
-        """when canvas  is resized, we create a new buffer, which will
-        be redrawn on next idle event"""
+        """when canvas  is resized, the last frame is stretched over
+        it for now. The buffer is reallocated (if it has to be) and
+        the canvas redrawn once no size event has come for a while,
+        so that a window being dragged to size isn't redrawn all along"""
         # update / initialize height and width
         self.width, self.height = self.GetSize()
-        
-        # update / create the buffer for the buffered dc
-        image = wx.EmptyImage(self.width, self.height)
-        wx.Image.Create(image, self.width, self.height, False)
-        wx.Image.SetRGBRect(image, wx.Rect(0, 0, self.width, self.height),
-                            255, 255, 255)        
-        self.buffer = wx.BitmapFromImage(image)
+        self.layout()
+        if self.buffer is None:
+            self.settle_resize()
+            return
+
+        if self.resize_timer is None:
+            self.resize_timer = wx.CallLater(RESIZE_SETTLE,
+                                             self.settle_resize)
+        else:
+            self.resize_timer.Restart(RESIZE_SETTLE)
+        self.draw_placeholder(wx.ClientDC(self))
+
+    def settle_resize(self):
+        """The resizing is over, redraw at the new size"""
+        self.resize_timer = None
+        self.resize_buffer()
         self.NEEDREDRAW = True
 
+    def resize_buffer(self):
+        """Make sure the buffer for the buffered dc covers the canvas.
+        It is made with some headroom, so it only has to be made
+        again when the canvas grows past it"""
+        if self.buffer is not None:
+            buffer_width, buffer_height = self.buffer.GetSize()
+            if buffer_width >= self.width and buffer_height >= self.height:
+                return
+        self.buffer = wx.EmptyBitmap(
+            (self.width // BUFFER_STEP + 1) * BUFFER_STEP,
+            (self.height // BUFFER_STEP + 1) * BUFFER_STEP)
+        dc = wx.MemoryDC()
+        dc.SelectObject(self.buffer)
+        dc.SetBackground(wx.WHITE_BRUSH)
+        dc.Clear()
+        dc.SelectObject(wx.NullBitmap)
+
+    def draw_placeholder(self, dc):
+        """Stretch the last frame drawn over the canvas"""
+        if not self.drawn_size or 0 in self.drawn_size:
+            return
+        drawn_width, drawn_height = self.drawn_size
+        bufferdc = wx.MemoryDC()
+        bufferdc.SelectObject(self.buffer)
+        dc.SetUserScale(self.width / float(drawn_width),
+                        self.height / float(drawn_height))
+        dc.Blit(0, 0, drawn_width, drawn_height, bufferdc, 0, 0)
+        bufferdc.SelectObject(wx.NullBitmap)
+
     def on_paint(self, event):
-        dc = wx.BufferedPaintDC(self, self.buffer)
+        if self.buffer is None:
+            dc = wx.PaintDC(self) # nothing to show yet
+        elif self.resize_timer is not None:
+            self.draw_placeholder(wx.PaintDC(self))
+        else:
+            dc = wx.BufferedPaintDC(self, self.buffer)
 
     def get_resize_params(self, imagewidth, imageheight):
         """calculate params for resizing image to canvas"""
@@ -132,26 +570,58 @@ class DisplayCanvas(wx.Panel):
         self.xoffset = (self.width-self.resized_width)/2
         self.yoffset = (self.height-self.resized_height)/2
 
+    def make_tools(self):
+        """Create the pens and brushes used in drawing, with
+        make_pen and make_brush. Implement in subclass"""
+        pass
+
+    def layout(self):
+        """Update whatever depends on the size of the canvas.
+        Implement in subclass"""
+        pass
+
     def draw(self, dc):
         """Drawing routine.Implement in subclass"""
         pass
 
 
 class ExifInfo():
-    """exif information for an image"""
-    def __init__(self, imagefilehandle):
+    """exif information for an image.
+    Only the tags in wanted_tags are read from the file, by default
+    all that are needed for the information list.
+    If the tags have already been read (eg by Exifreader.process_files)
+    they can be passed in as exifdata and the file is not read again"""
+    def __init__(self, imagefilehandle, wanted_tags=EXIF_INFO_TAGS,
+                 exifdata=None):
         self.imagefilehandle = imagefilehandle
-        self.read_exif_info()
+        self.wanted_tags = wanted_tags
+        if exifdata is None:
+            self.read_exif_info()
+        else:
+            self.exifdata = exifdata
         self.info = self.process_exif_info()
+        self.record = self.typed_info()
         self.exif_info_list = self.info_list()
         
     def read_exif_info(self):
         """read the exif information"""
         try:
-            self.exifdata = Exifreader.process_file(self.imagefilehandle)
+            self.exifdata = Exifreader.process_file(self.imagefilehandle,
+                                            wanted_tags=self.wanted_tags)
         except Exifreader.ExifError, msg:
             self. exifdata = None
 
+    def typed_info(self):
+        """The information that is compared and sorted on, parsed
+        once into numbers - time in seconds since 01-01-1970, aperture,
+        shutter time in seconds, focal length in mm and ISO.
+        Anything that is missing or can't be parsed is None"""
+        return {'time': exif_time_value(self.info.get('DateTime')),
+                'aperture': fraction_value(self.info.get('FNumber')),
+                'shutter': fraction_value(self.info.get('ExposureTime')),
+                'focal_length': fraction_value(self.info.get('FocalLength')),
+                'iso': int_value(self.info.get('ISOSpeed'))}
+
     def info_list(self):
         """exif information as a list of tuples"""
         return [('Model', '%s' %(self.info.get('Model', 'NA'))),
@@ -189,16 +659,11 @@ class ExifInfo():
         if not data:
             return info
 
-        #print data.keys()
-        for key in data.keys():
-            for wanted_key in ['ExposureMode', 'DateTime',
-                               'ExposureTime', 'FocalLength',
-                               'FlashMode', 'ISOSpeed',
-                               'Model', 'Orientation',
-                               'FNumber', 'LongFocalLengthOfLens',
-                               'ShortFocalLengthOfLens']:
-                if wanted_key in key:
-                    info[wanted_key] = str(data[key])
+        for name, keys in EXIF_INFO_KEYS:
+            for key in keys:
+                if key in data:
+                    info[name] = str(data[key])
+                    break
 
         return info
 